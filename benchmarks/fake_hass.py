@@ -0,0 +1,186 @@
+"""
+Just enough of Home Assistant to drive MainSwitch outside of HA.
+
+The state machine and service registry are plain dicts, light.turn_on is
+handled by a fake light platform which applies each call to the states
+straight away (expanding groups to their members), and the sun times come
+from a fixed stand-in instead of astral. The real homeassistant package is
+still needed for its constants and the State / ServiceCall classes.
+"""
+import asyncio
+import datetime
+
+import homeassistant.util.dt as dt_util
+from homeassistant.core import Service, ServiceCall, State
+from homeassistant.const import ATTR_ENTITY_ID, STATE_ON
+from homeassistant.components.light import (
+    ATTR_BRIGHTNESS,
+    ATTR_COLOR_MODE,
+    ATTR_COLOR_TEMP_KELVIN,
+    ColorMode,
+    DOMAIN as LIGHT_DOMAIN,
+    SERVICE_TURN_ON,
+    SERVICE_TOGGLE,
+)
+
+from custom_components.solar_lighting import DOMAIN
+from custom_components.solar_lighting.sun_times import DATA_SUN_TIMES
+from custom_components.solar_lighting.hass_utils import async_get_interceptor_hub
+
+class FakeConfig:
+    latitude = 51.5
+    longitude = 0.0
+    elevation = 0
+    time_zone = "UTC"
+
+class FakeBus:
+    def async_fire(self, *args, **kwargs):
+        pass
+
+    def async_listen(self, *args, **kwargs):
+        return lambda: None
+
+class FakeSunTimes:
+    """Stands in for sun_times.SunTimes, with fixed times"""
+    def __init__(self, times = (0.25, 0.5, 0.75)):
+        self.times = times
+
+    async def async_refresh(self, *args):
+        pass
+
+    def invalidate(self, *args):
+        pass
+
+class FakeStates:
+    def __init__(self):
+        self._states = {}
+        self.listeners = []
+
+    def get(self, entity_id):
+        return self._states.get(entity_id)
+
+    def async_set(self, entity_id, new_state, attributes = None, last_changed = None):
+        old = self._states.get(entity_id)
+        new = State(entity_id, new_state, attributes,
+                    last_changed = last_changed, validate_entity_id = False)
+        self._states[entity_id] = new
+        for listener in self.listeners:
+            listener(entity_id, old, new)
+
+class FakeServices:
+    def __init__(self, hass):
+        self.hass = hass
+        self._services = {}
+
+    def async_register(self, domain, service, func, schema = None):
+        self._services.setdefault(domain, {})[service] = Service(func, schema, domain, service)
+
+    async def async_call(self, domain, service, data = None, blocking = False, context = None):
+        handler = self._services[domain][service]
+        data = dict(data or {})
+        if handler.schema:
+            data = handler.schema(data)
+        job = handler.job.target(ServiceCall(domain, service, data, context))
+        if blocking:
+            await job
+        else:
+            # like HA, a non-blocking call just schedules the handler
+            self.hass.async_create_task(job)
+
+def light_service_schema(data):
+    # like light's own schema: entity ids normalised to a list, and the
+    # rest of the data moved into params
+    entity_ids = data.pop(ATTR_ENTITY_ID, [])
+    if isinstance(entity_ids, str):
+        entity_ids = [entity_ids]
+    return {ATTR_ENTITY_ID: entity_ids, "params": data}
+
+class FakeLights:
+    """The light platform: applies turn_on calls to the state machine
+    and counts them, one call being one message into the mesh."""
+    def __init__(self, hass, groups):
+        self.hass = hass
+        self.groups = groups
+        self.calls = 0
+        self.messages = []
+
+    async def async_turn_on(self, call):
+        self.calls += 1
+        params = call.data["params"]
+        now = dt_util.utcnow()
+        for entity_id in call.data[ATTR_ENTITY_ID]:
+            self.messages.append((now, entity_id, call.context))
+            for e in self.groups.get(entity_id) or [entity_id]:
+                self.set_light(e, params)
+
+    async def async_toggle(self, call):
+        await self.async_turn_on(call)
+
+    def set_light(self, entity_id, params, last_changed = None):
+        old = self.hass.states.get(entity_id)
+        attributes = dict(old.attributes) if old else {ATTR_COLOR_MODE: ColorMode.COLOR_TEMP}
+        for attr in (ATTR_BRIGHTNESS, ATTR_COLOR_TEMP_KELVIN):
+            if attr in params:
+                attributes[attr] = params[attr]
+        self.hass.states.async_set(entity_id, STATE_ON, attributes, last_changed)
+
+    def reset(self):
+        self.calls = 0
+        self.messages = []
+
+class FakeHass:
+    def __init__(self, groups = None, sun_times = None):
+        self.loop = asyncio.get_running_loop()
+        self.config = FakeConfig()
+        self.bus = FakeBus()
+        self.data = {DOMAIN: {DATA_SUN_TIMES: sun_times or FakeSunTimes()}}
+        self.states = FakeStates()
+        self.services = FakeServices(self)
+        self.lights = FakeLights(self, groups or {})
+        self.services.async_register(LIGHT_DOMAIN, SERVICE_TURN_ON,
+                                     self.lights.async_turn_on, light_service_schema)
+        self.services.async_register(LIGHT_DOMAIN, SERVICE_TOGGLE,
+                                     self.lights.async_toggle, light_service_schema)
+
+    def async_create_task(self, target, name = None):
+        return self.loop.create_task(target)
+
+    def async_create_background_task(self, target, name):
+        return self.loop.create_task(target)
+
+    async def async_add_executor_job(self, target, *args):
+        return target(*args)
+
+    def async_run_hass_job(self, job, *args):
+        # what async_call_later fires its action with
+        result = job.target(*args)
+        if asyncio.iscoroutine(result):
+            return self.loop.create_task(result)
+
+def attach(hass, switch):
+    """Do the parts of MainSwitch.async_added_to_hass we can do here:
+    intercept turn_on / toggle, and feed state changes to its snapshot.
+    Returns the functions which undo each."""
+    removers = [
+        async_get_interceptor_hub(hass, LIGHT_DOMAIN, service).async_register(
+            switch._lights_by_id.keys(), switch._timed_intercept_service_call
+        )
+        for service in (SERVICE_TURN_ON, SERVICE_TOGGLE)
+    ]
+    for entity_id in switch._lights_by_id:
+        switch._snapshot.update(entity_id, hass.states.get(entity_id))
+
+    def on_state_change(entity_id, old, new):
+        if entity_id in switch._lights_by_id:
+            switch._snapshot.update(entity_id, new)
+            if not(new and new.state == STATE_ON):
+                switch.clear_overrides_and_expectations(entity_id)
+    hass.states.listeners.append(on_state_change)
+    removers.append(lambda: hass.states.listeners.remove(on_state_change))
+    switch._state = True
+    switch._sleep_mode = False
+    return removers
+
+def old_enough():
+    # past the debounce in update_lights
+    return dt_util.utcnow() - datetime.timedelta(minutes = 1)
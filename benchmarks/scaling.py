@@ -0,0 +1,229 @@
+"""
+How MainSwitch scales with the number of lights and groups.
+
+Run from the top of the repository (homeassistant needs to be installed):
+
+    python -m benchmarks.scaling --output results.json
+    python -m benchmarks.scaling --compare results.json
+
+For each synthetic config this times a full tick (every light needs
+updating) and an idle tick (nothing has changed), measures the memory a
+full tick allocates, counts the light.turn_on calls it sends, and times
+turn_on calls going through the interceptor against calls straight to
+the light service.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from homeassistant.const import ATTR_ENTITY_ID, STATE_ON
+from homeassistant.components.light import (
+    ATTR_BRIGHTNESS,
+    ATTR_COLOR_MODE,
+    ATTR_COLOR_TEMP_KELVIN,
+    ColorMode,
+)
+
+from custom_components.solar_lighting.switch import PLATFORM_SCHEMA, MainSwitch
+
+from .fake_hass import FakeHass, attach, old_enough
+
+MANIFEST = Path(__file__).resolve().parent.parent / "custom_components" / "solar_lighting" / "manifest.json"
+
+ROOM_SIZE = 4
+
+def make_lights(n_lights, depth, overlap):
+    """Lights in rooms of ROOM_SIZE, and depth levels of groups above them
+    (room, zone of rooms, floor of zones...). Each overlap adds a layer of
+    room sized groups shifted so they straddle two rooms."""
+    lights = [f"light.l{i}" for i in range(n_lights)]
+    groups = {}
+
+    size = ROOM_SIZE
+    for level in range(depth):
+        for (j, start) in enumerate(range(0, n_lights, size)):
+            members = lights[start:start + size]
+            if len(members) > 1:
+                groups[f"light.g{level}_{j}"] = members
+        size *= ROOM_SIZE
+
+    for k in range(overlap):
+        offset = (k + 1) * ROOM_SIZE // (overlap + 1)
+        for (j, start) in enumerate(range(offset, n_lights, ROOM_SIZE)):
+            members = lights[start:start + ROOM_SIZE]
+            if len(members) > 1:
+                groups[f"light.o{k}_{j}"] = members
+
+    return lights, groups
+
+def make_switch(hass, lights, groups, batch):
+    config = PLATFORM_SCHEMA({
+        "platform": "solar_lighting",
+        "name": "bench",
+        # no tradfri split, so a tick isn't mostly waiting for transitions
+        "transition": 0,
+        "batch_evaluation": batch,
+        # the idle tick comes straight after, not once deliveries are checked
+        "delivery_retries": 0,
+        "lights": lights + [{ATTR_ENTITY_ID: g, "group": members}
+                            for (g, members) in groups.items()],
+    })
+    switch = MainSwitch(hass, config)
+    return switch, attach(hass, switch)
+
+def reset(hass, switch, lights):
+    # every light on, far from its target, and not changed recently
+    last_changed = old_enough()
+    for e in lights:
+        hass.states.async_set(e, STATE_ON, {ATTR_BRIGHTNESS: 1,
+                                            ATTR_COLOR_TEMP_KELVIN: 6500,
+                                            ATTR_COLOR_MODE: ColorMode.COLOR_TEMP},
+                              last_changed)
+    switch.clear_overrides_and_expectations()
+    hass.lights.reset()
+
+def summary(samples):
+    samples = sorted(samples)
+    return {"min": samples[0],
+            "median": statistics.median(samples),
+            "p95": samples[min(len(samples) - 1, round(0.95 * (len(samples) - 1)))]}
+
+async def timed_tick(switch):
+    start = time.perf_counter()
+    await switch.update_lights()
+    # sending happens in the background now, but it's part of the cost
+    await switch.async_wait_sent()
+    return (time.perf_counter() - start) * 1000
+
+async def bench_case(n_lights, depth, overlap, batch, repeat, calls):
+    lights, groups = make_lights(n_lights, depth, overlap)
+    hass = FakeHass(groups)
+    for e in lights:
+        hass.lights.set_light(e, {}, old_enough())
+    switch, removers = make_switch(hass, lights, groups, batch)
+
+    full = []
+    idle = []
+    for _ in range(repeat):
+        reset(hass, switch, lights)
+        full.append(await timed_tick(switch))
+        turn_on_calls = hass.lights.calls
+        # lights have just changed, so get them past the debounce
+        for e in lights:
+            hass.lights.set_light(e, {}, old_enough())
+        idle.append(await timed_tick(switch))
+
+    reset(hass, switch, lights)
+    tracemalloc.start()
+    await switch.update_lights()
+    await switch.async_wait_sent()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # user turn_on calls, through the interceptor and then without it (or
+    # the switch's state listener), each to the same lights
+    intercepted = await time_calls(hass, lights, calls)
+    foreign = await time_calls(hass, ["light.not_controlled"], calls)
+    for remove in removers:
+        remove()
+    direct = await time_calls(hass, lights, calls)
+    direct_foreign = await time_calls(hass, ["light.not_controlled"], calls)
+
+    return {
+        "lights": n_lights,
+        "depth": depth,
+        "overlap": overlap,
+        "groups": len(groups),
+        "batch_evaluation": batch,
+        # the idle tick comes straight after, not once deliveries are checked
+        "delivery_retries": 0,
+        "tick_ms": summary(full),
+        "idle_tick_ms": summary(idle),
+        "tick_peak_kib": peak / 1024,
+        "tick_retained_kib": current / 1024,
+        "turn_on_calls": turn_on_calls,
+        "messages_saved": switch._extra_attributes.get("Messages saved by grouping", 0),
+        "interceptor_us_per_call": intercepted - direct,
+        "passthrough_us_per_call": foreign - direct_foreign,
+    }
+
+async def time_calls(hass, entity_ids, calls, rounds = 3):
+    # the best of a few rounds, so a gc pass landing in one doesn't count
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for i in range(calls):
+            await hass.services.async_call("light", "turn_on",
+                                           {ATTR_ENTITY_ID: entity_ids[i % len(entity_ids)]},
+                                           blocking = True)
+        elapsed = (time.perf_counter() - start) * 1e6 / calls
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+async def run(args):
+    results = []
+    for n_lights in args.sizes:
+        for depth in args.depths:
+            for overlap in args.overlaps:
+                result = await bench_case(n_lights, depth, overlap, args.batch,
+                                          args.repeat, args.calls)
+                print(f"{n_lights:>5} lights depth {depth} overlap {overlap}: "
+                      f"tick {result['tick_ms']['median']:.2f}ms "
+                      f"idle {result['idle_tick_ms']['median']:.2f}ms "
+                      f"{result['turn_on_calls']} calls "
+                      f"intercept {result['interceptor_us_per_call']:.1f}us",
+                      file = sys.stderr)
+                results.append(result)
+    return results
+
+def compare(results, previous):
+    key = lambda r: (r["lights"], r["depth"], r["overlap"], r["batch_evaluation"])
+    before = {key(r): r for r in previous["results"]}
+    for r in results:
+        old = before.get(key(r))
+        if old is None: continue
+        ratio = r["tick_ms"]["median"] / old["tick_ms"]["median"]
+        calls = r["turn_on_calls"] - old["turn_on_calls"]
+        print(f"{r['lights']:>5} lights depth {r['depth']} overlap {r['overlap']}: "
+              f"tick x{ratio:.2f}, turn_on calls {calls:+d}")
+
+def int_list(value):
+    return [int(x) for x in value.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type = int_list, default = [10, 100, 1000, 5000])
+    parser.add_argument("--depths", type = int_list, default = [0, 1, 3])
+    parser.add_argument("--overlaps", type = int_list, default = [0, 1])
+    parser.add_argument("--batch", action = "store_true", help = "use batch_evaluation")
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--calls", type = int, default = 200,
+                        help = "turn_on calls when timing the interceptor")
+    parser.add_argument("--output", help = "write results here as json, rather than stdout")
+    parser.add_argument("--compare", help = "json from an earlier run to compare against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report = {
+        "version": json.loads(MANIFEST.read_text())["version"],
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": results,
+    }
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent = 2))
+    elif not(args.compare):
+        print(json.dumps(report, indent = 2))
+
+    if args.compare:
+        compare(results, json.loads(Path(args.compare).read_text()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+Replay a whole day through MainSwitch in simulated time, counting messages.
+
+Run from the top of the repository (homeassistant needs to be installed):
+
+    python -m benchmarks.simulate --lights 40 --depth 1
+    python -m benchmarks.simulate --config my_switch.yaml --events day.jsonl \\
+        --variant update_interval=30 --variant update_interval=120,transition=0
+
+The event loop runs on a fake clock which jumps straight to the next timer,
+and dt_util.utcnow / dt_util.now are patched to follow it, so the interval
+timer, the adaptive schedule, split turn ons and message pacing all happen
+in simulated time.
+
+--config is a yaml file holding one solar_lighting switch entry; without
+it a synthetic config is made as in benchmarks.scaling. --events is a log
+to replay, one json object per line, each with a "time" (iso format) and
+either a state change
+
+    {"time": "...", "entity_id": "light.x", "state": "on", "attributes": {...}}
+
+or a user service call, which goes through the interceptor:
+
+    {"time": "...", "service": "turn_on", "data": {"entity_id": "light.x"}}
+
+Without --events every light is on all day. Each --variant is a set of
+config overrides to run the day with; the results for each are printed
+as json.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import sys
+from collections import Counter
+from pathlib import Path
+
+import yaml
+
+import homeassistant.util.dt as dt_util
+from homeassistant.const import ATTR_ENTITY_ID, STATE_ON
+from homeassistant.components.light import (
+    ATTR_BRIGHTNESS,
+    ATTR_COLOR_MODE,
+    ATTR_COLOR_TEMP_KELVIN,
+    ColorMode,
+    DOMAIN as LIGHT_DOMAIN,
+)
+
+from custom_components.solar_lighting import DOMAIN, switch as switch_module
+from custom_components.solar_lighting.switch import PLATFORM_SCHEMA, MainSwitch
+from custom_components.solar_lighting.sun_times import DATA_SUN_TIMES, SunTimes
+
+from .fake_hass import FakeHass, attach
+from .scaling import make_lights
+
+class SimulatedClock:
+    def __init__(self, start):
+        self.start = start
+        self.seconds = 0.0
+
+    def advance(self, seconds):
+        self.seconds += seconds
+
+    def utcnow(self):
+        return self.start + datetime.timedelta(seconds = self.seconds)
+
+    def now(self, time_zone = None):
+        return self.utcnow().astimezone(time_zone or dt_util.DEFAULT_TIME_ZONE)
+
+class SimulatedLoop(asyncio.SelectorEventLoop):
+    """An event loop on the simulated clock: when it would wait for the
+    next timer, the clock jumps there instead."""
+    def __init__(self, clock):
+        super().__init__()
+        self._sim_clock = clock
+        select = self._selector.select
+
+        def jump(timeout = None):
+            if timeout:
+                clock.advance(timeout)
+            return select(0)
+        self._selector.select = jump
+
+    def time(self):
+        return self._sim_clock.seconds
+
+def track_point_in_time(hass, action, when):
+    # stands in for the helper the adaptive schedule uses
+    delay = (when - dt_util.utcnow()).total_seconds()
+    handle = hass.loop.call_later(max(0, delay), lambda: hass.async_create_task(action(when)))
+    return handle.cancel
+
+class Recorder:
+    """Counts what a switch does over the simulation"""
+    def __init__(self, switch):
+        self.ticks = 0
+        self.saved_by_grouping = 0
+        self.manual_overrides = 0
+
+        update_lights = switch.update_lights
+        async def counted_update_lights(*args):
+            self.ticks += 1
+            await update_lights(*args)
+            self.saved_by_grouping += switch._extra_attributes.get("Messages saved by grouping", 0)
+        switch.update_lights = counted_update_lights
+
+        for attr in ("brightness", "temperature"):
+            setattr(switch, f"set_manual_{attr}", self._counting(switch, attr))
+
+    def _counting(self, switch, attr):
+        set_manual = getattr(switch, f"set_manual_{attr}")
+        def counted(entity_id):
+            if entity_id not in getattr(switch, f"_manual_{attr}"):
+                self.manual_overrides += 1
+            set_manual(entity_id)
+        return counted
+
+def load_config(path, variant):
+    if path:
+        config = yaml.safe_load(Path(path).read_text())
+    else:
+        config = None
+    return PLATFORM_SCHEMA({"platform": "solar_lighting", **(config or {}), **variant})
+
+def synthetic_config(n_lights, depth, overlap):
+    lights, groups = make_lights(n_lights, depth, overlap)
+    return {"lights": lights + [{ATTR_ENTITY_ID: g, "group": members}
+                                for (g, members) in groups.items()]}
+
+def load_events(path):
+    events = []
+    for line in Path(path).read_text().splitlines():
+        if line.strip():
+            event = json.loads(line)
+            event["time"] = dt_util.as_utc(dt_util.parse_datetime(event["time"]))
+            events.append(event)
+    return sorted(events, key = lambda e: e["time"])
+
+async def simulate(config, start, duration, events):
+    hass = FakeHass()
+    hass.config.time_zone = str(dt_util.DEFAULT_TIME_ZONE)
+    sun_times = SunTimes(hass)
+    hass.data[DOMAIN][DATA_SUN_TIMES] = sun_times
+
+    switch = MainSwitch(hass, config)
+    hass.lights.groups = {g.entity_id: g.group for g in switch._groups}
+
+    lights = [light.entity_id for light in switch._lights]
+    if not(events):
+        for e in lights:
+            hass.states.async_set(e, STATE_ON, {ATTR_BRIGHTNESS: 255,
+                                                ATTR_COLOR_TEMP_KELVIN: 4000,
+                                                ATTR_COLOR_MODE: ColorMode.COLOR_TEMP},
+                                  start - datetime.timedelta(minutes = 1))
+
+    attach(hass, switch)
+    recorder = Recorder(switch)
+
+    def on_state_change(entity_id, old, new):
+        # what async_added_to_hass does for a light coming on
+        if switch._adaptive_schedule and entity_id in switch._lights_by_id and \
+           new and new.state == STATE_ON and not(old and old.state == STATE_ON):
+            switch._schedule_update(dt_util.utcnow() + datetime.timedelta(seconds = 1.5))
+    hass.states.listeners.append(on_state_change)
+
+    loop = hass.loop
+    for event in events:
+        delay = (event["time"] - start).total_seconds()
+        if 0 <= delay <= duration:
+            loop.call_later(delay, replay, hass, event)
+
+    timer = None
+    def interval():
+        nonlocal timer
+        hass.async_create_task(switch.update_lights())
+        timer = loop.call_later(switch._update_interval.total_seconds(), interval)
+
+    if not(switch._adaptive_schedule):
+        timer = loop.call_later(switch._update_interval.total_seconds(), interval)
+    await switch.update_lights()
+
+    await asyncio.sleep(duration)
+    if timer: timer.cancel()
+    switch._cancel_scheduled_update()
+    switch._pending.cancel_all()
+
+    ours = [(t, e) for (t, e, context) in hass.lights.messages if context == switch.context]
+    per_second = Counter(int((t - start).total_seconds()) for (t, _) in ours)
+    return {
+        "ticks": recorder.ticks,
+        "messages": len(ours),
+        "user_messages": len(hass.lights.messages) - len(ours),
+        "peak_messages_per_second": max(per_second.values(), default = 0),
+        "group_messages": sum(1 for (_, e) in ours if e in hass.lights.groups),
+        "messages_saved_by_grouping": recorder.saved_by_grouping,
+        "manual_overrides": recorder.manual_overrides,
+    }
+
+def replay(hass, event):
+    if "service" in event:
+        hass.async_create_task(
+            hass.services.async_call(LIGHT_DOMAIN, event["service"], event.get("data"))
+        )
+    else:
+        hass.states.async_set(event[ATTR_ENTITY_ID], event["state"], event.get("attributes"))
+
+def run(config, start, duration, events):
+    clock = SimulatedClock(start)
+    utcnow, now = dt_util.utcnow, dt_util.now
+    track = switch_module.async_track_point_in_time
+    dt_util.utcnow, dt_util.now = clock.utcnow, clock.now
+    switch_module.async_track_point_in_time = track_point_in_time
+    loop = SimulatedLoop(clock)
+    try:
+        return loop.run_until_complete(simulate(config, start, duration, events))
+    finally:
+        loop.close()
+        dt_util.utcnow, dt_util.now = utcnow, now
+        switch_module.async_track_point_in_time = track
+
+def parse_variant(value):
+    variant = {}
+    for item in value.split(","):
+        key, _, setting = item.partition("=")
+        variant[key.strip()] = yaml.safe_load(setting)
+    return variant
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument("--config", help = "yaml file with a solar_lighting switch entry")
+    parser.add_argument("--lights", type = int, default = 40, help = "synthetic config size")
+    parser.add_argument("--depth", type = int, default = 1)
+    parser.add_argument("--overlap", type = int, default = 0)
+    parser.add_argument("--events", help = "state / service event log to replay")
+    parser.add_argument("--date", type = datetime.date.fromisoformat,
+                        help = "day to simulate, by default today or the day of the first event")
+    parser.add_argument("--hours", type = float, default = 24)
+    parser.add_argument("--time-zone", default = "UTC")
+    parser.add_argument("--variant", type = parse_variant, action = "append",
+                        help = "config overrides, like update_interval=60,transition=0")
+    args = parser.parse_args()
+
+    dt_util.set_default_time_zone(dt_util.get_time_zone(args.time_zone))
+    events = load_events(args.events) if args.events else []
+    date = args.date or (events[0]["time"].astimezone(dt_util.DEFAULT_TIME_ZONE).date()
+                         if events else dt_util.now().date())
+    start = dt_util.as_utc(dt_util.start_of_local_day(date))
+
+    base = {} if args.config else synthetic_config(args.lights, args.depth, args.overlap)
+    results = []
+    for variant in args.variant or [{}]:
+        config = load_config(args.config, {**base, **variant})
+        result = run(config, start, args.hours * 3600, events)
+        print(f"{variant or 'as configured'}: {result['messages']} messages, "
+              f"peak {result['peak_messages_per_second']}/s", file = sys.stderr)
+        results.append({"variant": variant, **result})
+
+    print(json.dumps(results, indent = 2))
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,27 @@ Reason for existence is
 - I want to be able to adapt some switches only when switched on, and some over time
   without setting up lots of identical configurations
 """
+import voluptuous as vol
+
+import homeassistant.helpers.config_validation as cv
+from homeassistant.const import ATTR_ENTITY_ID
+from homeassistant.core import SupportsResponse
+
+from .trace import DATA_TRACES
+
 DOMAIN = "solar_lighting"
 
+SERVICE_DUMP_TRACE = "dump_trace"
+
 async def async_setup(hass, config) -> bool:
+    async def dump_trace(call):
+        traces = hass.data.get(DOMAIN, {}).get(DATA_TRACES, {})
+        wanted = call.data.get(ATTR_ENTITY_ID) or list(traces)
+        return {entity_id: traces[entity_id].events() for entity_id in wanted if entity_id in traces}
+
+    hass.services.async_register(DOMAIN, SERVICE_DUMP_TRACE, dump_trace,
+                                 schema = vol.Schema({vol.Optional(ATTR_ENTITY_ID): cv.entity_ids}),
+                                 supports_response = SupportsResponse.ONLY)
     return True
 
 # TODO
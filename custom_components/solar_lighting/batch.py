@@ -0,0 +1,117 @@
+"""
+Batched evaluation of every light's targets in one vectorized pass.
+
+The per-light settings are packed into arrays once, when the switch is
+configured. Each tick the caller fills in the current state of each light
+and gets back which lights have gone manual and which need an update, so
+only those lights go through the python grouping / dispatch code.
+
+Needs numpy; if it's not installed the switch falls back to evaluating
+lights one at a time.
+"""
+from .curves import curve_tables, minute_of_day
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _curves(lights, attr):
+    keys = []
+    index = {}
+    per_light = []
+    for light in lights:
+        key = light.profile.curve(attr)
+        if key not in index:
+            index[key] = len(keys)
+            keys.append(key)
+        per_light.append(index[key])
+    return keys, np.array(per_light, dtype = np.intp)
+
+def _settings(lights, name, dtype):
+    return np.array([getattr(light.profile, name) for light in lights], dtype = dtype)
+
+class LightBatch:
+    def __init__(self, lights):
+        self.size = len(lights)
+        self.brightness_profiles, self.brightness_profile = _curves(lights, "brightness")
+        self.temperature_profiles, self.temperature_profile = _curves(lights, "temperature")
+        self.brightness_delta = _settings(lights, "brightness_update_delta", float)
+        self.temperature_delta = _settings(lights, "temperature_update_delta", float)
+        self.brightness_adjust = _settings(lights, "brightness_adjust", bool)
+        self.temperature_adjust = _settings(lights, "temperature_adjust", bool)
+        self.sleep_brightness = _settings(lights, "sleep_brightness", np.int64)
+        self.sleep_temperature = _settings(lights, "sleep_temperature", np.int64)
+
+    def new_state(self):
+        """Arrays for the caller to fill in with the current light state.
+
+        Unknown brightness / temperature / expectations are left as NaN.
+        """
+        n = self.size
+        return {
+            "active": np.zeros(n, dtype = bool),
+            "brightness": np.full(n, np.nan),
+            "temperature": np.full(n, np.nan),
+            "expected_brightness": np.full(n, np.nan),
+            "expected_temperature": np.full(n, np.nan),
+            "manual_brightness": np.zeros(n, dtype = bool),
+            "manual_temperature": np.zeros(n, dtype = bool),
+            "supports_brightness": np.zeros(n, dtype = bool),
+            "supports_temperature": np.zeros(n, dtype = bool),
+            "min_kelvin": np.full(n, np.nan),
+            "max_kelvin": np.full(n, np.nan),
+        }
+
+    def targets(self, sleep_mode, times):
+        if sleep_mode:
+            return self.sleep_brightness, self.sleep_temperature
+        now, sunrise, noon, sunset = times
+        sun = (sunrise, noon, sunset)
+        minute = minute_of_day(now)
+        brightness = np.array([curve_tables.table(sun, *p)[minute]
+                               for p in self.brightness_profiles], dtype = np.int64)
+        temperature = np.array([curve_tables.table(sun, *p)[minute]
+                                for p in self.temperature_profiles], dtype = np.int64)
+        return (brightness[self.brightness_profile],
+                temperature[self.temperature_profile])
+
+    def evaluate(self, sleep_mode, times, state):
+        """Evaluate every light at once.
+
+        Mirrors the per-light logic in MainSwitch.update_lights: a light
+        whose value has drifted from what we expected has gone manual; an
+        attribute is included in the update if it's adjusted, not manual
+        and the light supports it; and a light needs updating if an
+        included attribute is unknown or out by more than the delta.
+        """
+        active = state["active"]
+        cur_b = state["brightness"]
+        cur_t = state["temperature"]
+        target_b, target_t = self.targets(sleep_mode, times)
+        # into each light's kelvin range, where we know it (fmin / fmax skip NaN)
+        target_t = np.fmin(np.fmax(target_t, state["min_kelvin"]), state["max_kelvin"])
+
+        with np.errstate(invalid = "ignore"):
+            went_manual_b = active & (np.abs(state["expected_brightness"] - cur_b) > self.brightness_delta)
+            went_manual_t = active & (np.abs(state["expected_temperature"] - cur_t) > self.temperature_delta)
+
+            include_b = active & self.brightness_adjust & state["supports_brightness"] & \
+                ~(state["manual_brightness"] | went_manual_b)
+            include_t = active & self.temperature_adjust & state["supports_temperature"] & \
+                ~(state["manual_temperature"] | went_manual_t)
+
+            out_b = np.isnan(cur_b) | (np.abs(cur_b - target_b) > self.brightness_delta)
+            out_t = np.isnan(cur_t) | (np.abs(cur_t - target_t) > self.temperature_delta)
+
+        needs_update = (include_b & out_b) | (include_t & out_t)
+
+        return {
+            "brightness": target_b,
+            "temperature": target_t,
+            "went_manual_brightness": np.flatnonzero(went_manual_b),
+            "went_manual_temperature": np.flatnonzero(went_manual_t),
+            "include_brightness": include_b,
+            "include_temperature": include_t,
+            "needs_update": np.flatnonzero(needs_update),
+        }
@@ -0,0 +1,78 @@
+"""
+What each light can do.
+
+Supported colour modes and the kelvin range only change if the light is
+re-paired or its integration changes, so they're worked out when they
+change rather than on every state update. We also remember whether a
+light copes with brightness and temperature changing in one command (the
+IKEA tradfri bulbs don't), either from config or by trying it.
+"""
+from homeassistant.components.light import (
+    ATTR_COLOR_MODE,
+    ATTR_MAX_COLOR_TEMP_KELVIN,
+    ATTR_MIN_COLOR_TEMP_KELVIN,
+    ATTR_SUPPORTED_COLOR_MODES,
+    ColorMode,
+    brightness_supported,
+    color_supported,
+    color_temp_supported,
+)
+
+# split_turn_on settings
+SPLIT_ALWAYS = "always"
+SPLIT_NEVER = "never"
+SPLIT_LEARN = "learn"
+
+class Capabilities:
+    __slots__ = ("key", "supports_brightness", "supports_temperature",
+                 "min_kelvin", "max_kelvin")
+
+    def __init__(self, key):
+        self.key = key
+        modes, min_kelvin, max_kelvin, color_mode = key
+        if modes:
+            self.supports_brightness = brightness_supported(modes)
+            # HA converts kelvin for lights which only do colour
+            self.supports_temperature = color_temp_supported(modes) or color_supported(modes)
+        else:
+            # no supported modes, so go on the mode it's in
+            self.supports_brightness = color_mode != ColorMode.ONOFF
+            self.supports_temperature = color_mode not in (ColorMode.ONOFF, ColorMode.BRIGHTNESS)
+        self.min_kelvin = min_kelvin
+        self.max_kelvin = max_kelvin
+
+    def clamp_kelvin(self, kelvin):
+        if self.min_kelvin and kelvin < self.min_kelvin:
+            return self.min_kelvin
+        if self.max_kelvin and kelvin > self.max_kelvin:
+            return self.max_kelvin
+        return kelvin
+
+def capability_key(state):
+    attributes = state.attributes
+    modes = attributes.get(ATTR_SUPPORTED_COLOR_MODES)
+    return (frozenset(modes) if modes else None,
+            attributes.get(ATTR_MIN_COLOR_TEMP_KELVIN),
+            attributes.get(ATTR_MAX_COLOR_TEMP_KELVIN),
+            # only matters when there are no supported modes
+            None if modes else attributes.get(ATTR_COLOR_MODE))
+
+class CapabilityCache:
+    def __init__(self):
+        self._capabilities = {}
+        # whether a combined brightness + temperature change works, by
+        # light, if known; survives its capabilities being recomputed
+        self._simultaneous = {}
+
+    def update(self, entity_id, state):
+        key = capability_key(state)
+        capabilities = self._capabilities.get(entity_id)
+        if capabilities is None or capabilities.key != key:
+            capabilities = self._capabilities[entity_id] = Capabilities(key)
+        return capabilities
+
+    def learned(self, entity_id, simultaneous):
+        self._simultaneous[entity_id] = simultaneous
+
+    def simultaneous(self, entity_id):
+        return self._simultaneous.get(entity_id)
@@ -0,0 +1,157 @@
+"""
+One tick for every switch with shared_tick.
+
+A switch on its own timer reads the time and sun times for itself, groups
+only its own lights and sends its own burst of commands, so a light group
+with members in two switches can never stand in for them. Switches with
+shared_tick register here instead: one timer ticks them all together,
+each works out its targets against the same times, and the targets are
+grouped as one over every group whose members all belong to some
+registered switch, giving one plan of commands per tick.
+"""
+import time
+import logging
+
+from homeassistant.core import callback
+from homeassistant.const import ATTR_ENTITY_ID
+from homeassistant.helpers.event import async_track_time_interval
+
+from . import DOMAIN
+
+from .dispatch import start_plans
+from .grouping import GroupIndex
+from .group_discovery import async_get_group_discovery
+from .sun_times import get_times
+
+log = logging.getLogger(__name__)
+
+DATA_TICK_COORDINATOR = "tick_coordinator"
+
+class TickCoordinator:
+    def __init__(self, hass):
+        self.hass = hass
+        self._switches = []
+        # light -> the switch controlling it
+        self._owners = {}
+        self._group_index = None
+        self._interval = None
+        self._unsub_interval = None
+
+    def owner(self, entity_id):
+        return self._owners.get(entity_id)
+
+    @callback
+    def async_register(self, switch):
+        self._switches.append(switch)
+        self._registrations_changed()
+
+        @callback
+        def unregister():
+            self._switches.remove(switch)
+            self._registrations_changed()
+        return unregister
+
+    @callback
+    def async_groups_changed(self):
+        self._group_index = None
+
+    def _registrations_changed(self):
+        self._owners = {}
+        for switch in self._switches:
+            for entity_id in switch._light_index:
+                self._owners.setdefault(entity_id, switch)
+        self._group_index = None
+
+        # tick as often as the most frequent switch on an interval; the
+        # adaptive ones ask for ticks when they need them
+        intervals = [s._update_interval for s in self._switches if not(s._adaptive_schedule)]
+        interval = min(intervals) if intervals else None
+        if interval == self._interval: return
+        if self._unsub_interval:
+            self._unsub_interval()
+            self._unsub_interval = None
+        self._interval = interval
+        if interval:
+            self._unsub_interval = async_track_time_interval(self.hass, self._async_interval_tick,
+                                                             interval)
+
+    @property
+    def group_index(self):
+        if self._group_index is None:
+            groups = {}
+            for switch in self._switches:
+                groups.update(switch._group_index.members)
+            if any(s._discover_groups for s in self._switches):
+                # including ones spanning switches, which none of them
+                # could use alone
+                for (group, members) in async_get_group_discovery(self.hass).groups.items():
+                    if group in groups or group in self._owners: continue
+                    if all(e in self._owners for e in members):
+                        groups[group] = members
+            self._group_index = GroupIndex(groups)
+        return self._group_index
+
+    async def _async_interval_tick(self, *args):
+        await self.async_run_tick(full = True)
+
+    async def async_run_tick(self, full = True):
+        """Like MainSwitch._async_run_tick, but for everyone"""
+        self._tick(full)
+
+    def _tick(self, full):
+        started = time.perf_counter()
+        times = get_times(self.hass)
+
+        prepared = []
+        waves = []
+        wave_delay = 0
+        for switch in self._switches:
+            result = switch._prepare_tick(times, full)
+            if result is None: continue
+            prepared.append((switch, result))
+            target_state, needs_update, switch_waves, delay = result
+            for (i, wave) in enumerate(switch_waves):
+                if i == len(waves):
+                    waves.append({})
+                for (entity_id, state) in wave.items():
+                    waves[i].setdefault(entity_id, state)
+            wave_delay = max(wave_delay, delay)
+        if not(prepared): return
+        # an empty second wave is no wave at all
+        while len(waves) > 1 and not(waves[-1]):
+            waves.pop()
+
+        index = self.group_index
+        plans = [index.plan(wave)[0] for wave in waves]
+        members = index.members
+        commands = {switch: [] for (switch, _) in prepared}
+        wanted = {}
+        for (wave, plan) in enumerate(plans):
+            for (entity_id, state) in plan.items():
+                state[ATTR_ENTITY_ID] = entity_id
+                wanted.setdefault(entity_id, []).append(state)
+                covered = members.get(entity_id) or (entity_id,)
+                owner = self._owners[covered[0]]
+                commands.setdefault(owner, []).append((wave, entity_id, state, covered))
+
+        for (switch, (target_state, needs_update, switch_waves, _)) in prepared:
+            switch._record_commands(target_state, switch_waves, commands[switch])
+            switch._supersede(needs_update, retargeted = needs_update, wanted = wanted)
+
+        def start(entity_id, state, after):
+            covered = members.get(entity_id) or (entity_id,)
+            owner, *sharers = dict.fromkeys(self._owners[e] for e in covered)
+            return owner._start_planned(entity_id, state, after, covered, sharers)
+        start_plans(self.hass, plans, wave_delay, start)
+
+        for (switch, _) in prepared:
+            switch._record_tick(started)
+
+@callback
+def async_get_tick_coordinator(hass):
+    """Get the shared tick coordinator, creating it on first use."""
+    data = hass.data.setdefault(DOMAIN, {})
+    coordinator = data.get(DATA_TICK_COORDINATOR)
+    if coordinator is None:
+        coordinator = data[DATA_TICK_COORDINATOR] = TickCoordinator(hass)
+    return coordinator
@@ -0,0 +1,65 @@
+"""
+Brightness / temperature curves.
+
+The curve only depends on the day's sun times and the (k, x, min, max)
+settings, and times are only ever resolved to the minute, so for each
+distinct settings profile we build a table of the whole day once and
+then read it by index.
+"""
+from math import tanh
+
+MINUTES_PER_DAY = 24 * 60
+
+def evaluate_curve(times, k, x, minimum, maximum):
+    now, sunrise, noon, sunset = times
+    if now < noon:
+        x = (1+tanh(k*(now - (sunrise + x))))/2
+    else:
+        x = (1+tanh(k*(sunset - (now + x))))/2
+    return int(minimum + (maximum - minimum) * x)
+
+def minute_of_day(now):
+    return round(now * MINUTES_PER_DAY) % MINUTES_PER_DAY
+
+def build_table(sun, k, x, minimum, maximum):
+    sunrise, noon, sunset = sun
+    # same arithmetic as get_times, so a table read is exactly what
+    # evaluate_curve would have said for that minute
+    return [evaluate_curve(((m // 60 + (m % 60) / 60) / 24, sunrise, noon, sunset),
+                           k, x, minimum, maximum)
+            for m in range(MINUTES_PER_DAY)]
+
+def next_change(table, minute, delta, value = None):
+    """The first minute after `minute` today at which the curve has moved
+    by more than `delta` from `value` (by default its value at `minute`),
+    or None."""
+    if value is None:
+        value = table[minute]
+    for m in range(minute + 1, MINUTES_PER_DAY):
+        if abs(table[m] - value) > delta:
+            return m
+    return None
+
+class CurveTables:
+    def __init__(self):
+        self._sun = None
+        self._tables = {}
+
+    def table(self, sun, k, x, minimum, maximum):
+        if sun != self._sun:
+            # new day (or new location), so all the old tables are stale
+            self._sun = sun
+            self._tables = {}
+        key = (k, x, minimum, maximum)
+        table = self._tables.get(key)
+        if table is None:
+            table = self._tables[key] = build_table(sun, k, x, minimum, maximum)
+        return table
+
+    def lookup(self, times, k, x, minimum, maximum):
+        now, sunrise, noon, sunset = times
+        return self.table((sunrise, noon, sunset), k, x, minimum, maximum)[minute_of_day(now)]
+
+# tables are a pure function of their key, so one set can be shared by
+# every instance in the process
+curve_tables = CurveTables()
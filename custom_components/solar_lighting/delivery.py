@@ -0,0 +1,82 @@
+"""
+Checking that lights got what we sent them.
+
+Zigbee lights, in groups particularly, sometimes miss a message. Once a
+command has gone out and had time to transition, each light it covered is
+looked at: if it got there, good; if it hasn't changed at all, the message
+was missed and that light alone gets it again; if it changed to something
+else, someone else changed it, which the manual change check deals with.
+"""
+from homeassistant.components.light import (
+    ATTR_BRIGHTNESS,
+    ATTR_COLOR_TEMP_KELVIN,
+)
+
+# seconds to wait after a command's transition before looking
+DELIVERY_TIMEOUT = 5
+
+DELIVERED = "delivered"
+MISSED = "missed"
+CHANGED = "changed"
+
+class Delivery:
+    __slots__ = ("target", "before", "attempt")
+
+    def __init__(self, target, before, attempt):
+        # just the brightness / temperature we sent
+        self.target = target
+        # the light's LightState when we sent it
+        self.before = before
+        self.attempt = attempt
+
+    def outcome(self, current, profile):
+        """How it went, and the attributes which didn't get there"""
+        missing = {}
+        changed = False
+        # a light never reports what it doesn't support, so that can't be missed
+        capabilities = current.capabilities
+        for (attr, value, before, delta, supported) in (
+                (ATTR_BRIGHTNESS, current.brightness,
+                 self.before.brightness if self.before else None,
+                 profile.brightness_update_delta, capabilities.supports_brightness),
+                (ATTR_COLOR_TEMP_KELVIN, current.temperature,
+                 self.before.temperature if self.before else None,
+                 profile.temperature_update_delta, capabilities.supports_temperature)):
+            if attr not in self.target or not(supported): continue
+            if value is not None and abs(value - self.target[attr]) <= delta: continue
+            missing[attr] = self.target[attr]
+            changed = changed or value != before
+        if not(missing):
+            return DELIVERED, missing
+        return (CHANGED if changed else MISSED), missing
+
+class Deliveries:
+    """The latest command sent to each light that we're waiting to check"""
+    def __init__(self):
+        self._by_light = {}
+
+    def __contains__(self, entity_id):
+        return entity_id in self._by_light
+
+    def watch(self, entity_id, delivery):
+        # a split update's brightness arrives as a second command, so
+        # we're then waiting on both
+        previous = self._by_light.get(entity_id)
+        if previous:
+            delivery.target = {**previous.target, **delivery.target}
+            delivery.before = previous.before
+        self._by_light[entity_id] = delivery
+
+    def take(self, entity_id, delivery):
+        """Stop watching entity_id, if delivery is still what we're waiting
+        on for it (a newer command replaces it)"""
+        if self._by_light.get(entity_id) is delivery:
+            del self._by_light[entity_id]
+            return True
+        return False
+
+    def discard(self, entity_id):
+        self._by_light.pop(entity_id, None)
+
+    def clear(self):
+        self._by_light.clear()
@@ -0,0 +1,186 @@
+"""
+Pacing light commands into the mesh.
+
+Firing dozens of light.turn_on calls at once is what makes zigbee lights
+miss messages, so commands are queued here and sent with at most
+max_in_flight outstanding and at least spacing seconds between background
+commands. Interactive commands (a user turning a light on) have their own
+lane, which always goes first and isn't spaced out or capped: a light
+group's turn_on calls turn_on for its members from inside the outer call,
+and those come back through the interactive lane, so capping it could
+leave the outer call waiting on its own members forever.
+"""
+import asyncio
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+class Dispatcher:
+    def __init__(self, hass, max_in_flight = 0, spacing = 0):
+        self.hass = hass
+        self._max_in_flight = max_in_flight
+        self._spacing = spacing
+        self._interactive = deque()
+        self._background = deque()
+        self._in_flight = 0
+        self._last_sent = None
+        self._wakeup = asyncio.Event()
+        self._pump = None
+
+    def async_run(self, job, interactive = False):
+        """Queue job, a function returning an awaitable.
+
+        Returns a future for the job's result. Background jobs that fail
+        are logged and resolve to None; interactive jobs pass their
+        exception on, as the caller is waiting on them.
+        """
+        future = self.hass.loop.create_future()
+        lane = self._interactive if interactive else self._background
+        lane.append((job, future, interactive))
+        self._wakeup.set()
+        if self._pump is None:
+            self._pump = self.hass.async_create_background_task(
+                self._async_pump(), "solar_lighting dispatcher"
+            )
+        return future
+
+    async def async_run_interactive(self, job):
+        return await self.async_run(job, interactive = True)
+
+    async def _async_pump(self):
+        loop = self.hass.loop
+        try:
+            while self._interactive or self._background:
+                self._wakeup.clear()
+
+                if self._interactive:
+                    lane = self._interactive
+                else:
+                    if self._max_in_flight and self._in_flight >= self._max_in_flight:
+                        await self._wakeup.wait()
+                        continue
+                    if self._spacing and self._last_sent is not None:
+                        delay = self._last_sent + self._spacing - loop.time()
+                        if delay > 0:
+                            # an interactive job arriving wakes us early
+                            try:
+                                await asyncio.wait_for(self._wakeup.wait(), delay)
+                            except asyncio.TimeoutError:
+                                pass
+                            continue
+                    lane = self._background
+
+                job, future, interactive = lane.popleft()
+                if future.done(): continue
+                if not(interactive): self._in_flight += 1
+                self._last_sent = loop.time()
+                self.hass.async_create_task(self._async_execute(job, future, interactive))
+        finally:
+            self._pump = None
+
+    async def _async_execute(self, job, future, interactive):
+        try:
+            result = await job()
+        except Exception as error:
+            if interactive:
+                if not(future.done()): future.set_exception(error)
+            else:
+                log.exception("Error sending light command")
+                if not(future.done()): future.set_result(None)
+        else:
+            if not(future.done()): future.set_result(result)
+        finally:
+            if not(interactive): self._in_flight -= 1
+            self._wakeup.set()
+
+def start_plans(hass, plans, wave_delay, start):
+    """Start the commands in plans, a list of waves of {key: target}.
+
+    With one wave everything goes now; otherwise the first wave goes now
+    and the second once the first has finished sending and transitioning,
+    plus wave_delay. start(key, target, after) starts one command and
+    returns its task, or None if it's already on its way.
+    """
+    if len(plans) == 1:
+        for (key, target) in plans[0].items():
+            start(key, target, None)
+    elif any(plans):
+        first_wave = []
+        go = asyncio.Event()
+        for (wave, plan) in enumerate(plans):
+            for (key, target) in plan.items():
+                task = start(key, target, go if wave else None)
+                if task is not None and not(wave): first_wave.append(task)
+        hass.async_create_task(_async_release_wave(first_wave, wave_delay, go))
+
+async def _async_release_wave(previous, delay, go):
+    if previous:
+        await asyncio.wait(previous)
+    await asyncio.sleep(delay)
+    go.set()
+
+class PendingCommand:
+    __slots__ = ("key", "target", "covered", "unsent", "task")
+
+    def __init__(self, key, target, covered):
+        self.key = key
+        self.target = target
+        self.covered = covered
+        # attributes not yet sent; the command's sender removes them
+        # as it goes, so if it's cancelled we know what didn't go out
+        self.unsent = set(target)
+        self.task = None
+
+class PendingCommands:
+    """Commands we've started but not finished, indexed by the lights they cover.
+
+    When a light gets a new target, whatever is still pending for it (queued,
+    or a split turn on waiting to send brightness) is cancelled so only the
+    latest target goes out.
+    """
+    def __init__(self):
+        self._by_light = {}
+
+    def add(self, command):
+        for e in command.covered:
+            self._by_light.setdefault(e, []).append(command)
+        command.task.add_done_callback(lambda _: self._remove(command))
+
+    def _remove(self, command):
+        for e in command.covered:
+            commands = self._by_light.get(e)
+            if commands and command in commands:
+                commands.remove(command)
+                if not(commands): del self._by_light[e]
+
+    def tasks(self):
+        return {c.task for commands in self._by_light.values() for c in commands}
+
+    def is_pending(self, key, covered, target):
+        """Whether exactly this command is already on its way"""
+        return any(c.key == key and c.target == target
+                   for c in self._by_light.get(covered[0], ()))
+
+    def unsent(self, light):
+        """Attributes still to be sent to light by pending commands"""
+        commands = self._by_light.get(light)
+        if not(commands): return ()
+        if len(commands) == 1: return commands[0].unsent
+        return set().union(*(c.unsent for c in commands))
+
+    def supersede(self, lights, wanted = None):
+        """Cancel anything pending for lights, except commands that are in
+        wanted (a dict of key -> targets); returns the cancelled commands"""
+        cancelled = []
+        for e in lights:
+            for command in list(self._by_light.get(e, ())):
+                if wanted and command.target in wanted.get(command.key, ()):
+                    continue
+                self._remove(command)
+                command.task.cancel()
+                cancelled.append(command)
+        return cancelled
+
+    def cancel_all(self):
+        return self.supersede(list(self._by_light))
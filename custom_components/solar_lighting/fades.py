@@ -0,0 +1,40 @@
+"""
+Long transitions the lights do themselves.
+
+With lookahead, a light is sent where the curve will be some minutes
+from now with a transition that long, and the bulb fades there on its
+own. While it does, we follow the straight line from where the curve was
+when it started to where it's going, and only send it something new if
+the curve bends away from that line by more than the update delta.
+"""
+class Fade:
+    __slots__ = ("origin", "start", "end", "started", "finishes")
+
+    def __init__(self, origin, start, end, started, finishes):
+        # {attribute: value} for where the light was, and for each end of
+        # the line; the light was within a delta or so of the start
+        self.origin = origin
+        self.start = start
+        self.end = end
+        self.started = started
+        self.finishes = finishes
+
+    def __contains__(self, attr):
+        return attr in self.end
+
+    def finished(self, now):
+        return now >= self.finishes
+
+    def value(self, attr, now):
+        """Where the curve should be now, if it's straight"""
+        fraction = (now - self.started) / (self.finishes - self.started)
+        fraction = min(1, max(0, fraction))
+        return self.start[attr] + (self.end[attr] - self.start[attr]) * fraction
+
+    def covers(self, attr, value, delta):
+        """Whether value is somewhere the fade could have the light, give or
+        take delta; integrations differ in whether they report the fade's
+        progress or its end"""
+        low = min(self.origin[attr], self.start[attr], self.end[attr])
+        high = max(self.origin[attr], self.start[attr], self.end[attr])
+        return low - delta <= value <= high + delta
@@ -0,0 +1,81 @@
+"""
+Finding light groups and their members without being told.
+
+Light groups (HA's own, and the zigbee integrations that expose one) list
+their members in an entity_id attribute. We read those once, keep them,
+and only look again when the entity or device registry changes, or when
+HA has finished starting and every light has a state.
+"""
+import logging
+
+from homeassistant.core import callback
+from homeassistant.const import ATTR_ENTITY_ID, EVENT_HOMEASSISTANT_STARTED
+from homeassistant.components.light import DOMAIN as LIGHT_DOMAIN
+from homeassistant.helpers import device_registry as dr, entity_registry as er
+from homeassistant.helpers.event import async_call_later
+
+from . import DOMAIN
+
+log = logging.getLogger(__name__)
+
+DATA_GROUP_DISCOVERY = "group_discovery"
+
+# registry updates come in bursts, so wait for them to settle
+REFRESH_DELAY = 2
+
+def group_members(state):
+    members = state.attributes.get(ATTR_ENTITY_ID)
+    if isinstance(members, (list, tuple)) and len(members) > 1:
+        return tuple(members)
+    return None
+
+class GroupDiscovery:
+    def __init__(self, hass):
+        self.hass = hass
+        self.groups = {}
+        self._listeners = []
+        self._unsub_refresh = None
+
+    @callback
+    def async_add_listener(self, listener):
+        self._listeners.append(listener)
+        return lambda: self._listeners.remove(listener)
+
+    @callback
+    def async_refresh(self, *args):
+        self._unsub_refresh = None
+        registry = er.async_get(self.hass)
+        groups = {}
+        for state in self.hass.states.async_all(LIGHT_DOMAIN):
+            members = group_members(state)
+            if members is None: continue
+            entry = registry.async_get(state.entity_id)
+            if entry and entry.disabled: continue
+            groups[state.entity_id] = members
+
+        if groups != self.groups:
+            log.debug("Discovered light groups %s", groups)
+            self.groups = groups
+            for listener in list(self._listeners):
+                listener()
+
+    @callback
+    def async_schedule_refresh(self, *args):
+        if self._unsub_refresh:
+            self._unsub_refresh()
+        self._unsub_refresh = async_call_later(self.hass, REFRESH_DELAY, self.async_refresh)
+
+@callback
+def async_get_group_discovery(hass):
+    """Get the shared group discovery, creating it on first use."""
+    data = hass.data.setdefault(DOMAIN, {})
+    discovery = data.get(DATA_GROUP_DISCOVERY)
+    if discovery is None:
+        discovery = data[DATA_GROUP_DISCOVERY] = GroupDiscovery(hass)
+        hass.bus.async_listen(er.EVENT_ENTITY_REGISTRY_UPDATED, discovery.async_schedule_refresh)
+        hass.bus.async_listen(dr.EVENT_DEVICE_REGISTRY_UPDATED, discovery.async_schedule_refresh)
+        if hass.is_running:
+            discovery.async_refresh()
+        else:
+            hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STARTED, discovery.async_refresh)
+    return discovery
@@ -0,0 +1,122 @@
+"""
+Choosing which groups to send messages to.
+
+A group can stand in for its members if every member needs updating to
+the same target. Groups can overlap (room / zone / floor), so we want the
+set of non-overlapping usable groups that replaces the most individual
+messages; the members left over get their own message. Each light ends
+up covered by exactly one message.
+"""
+# above this many mutually overlapping candidate groups we stop looking
+# for the best plan and take a greedy one
+EXACT_SEARCH_LIMIT = 16
+
+class GroupIndex:
+    def __init__(self, groups):
+        """groups maps group entity id -> member entity ids"""
+        self.groups = {g: frozenset(members) for (g, members) in groups.items()}
+        self.members = {g: tuple(members) for (g, members) in groups.items()}
+        self.by_member = {}
+        for (g, members) in self.groups.items():
+            for e in members:
+                self.by_member.setdefault(e, []).append(g)
+
+    def candidates(self, target_state):
+        """Groups whose members all have the same target"""
+        seen = set()
+        result = []
+        for e in target_state:
+            for g in self.by_member.get(e, ()):
+                if g in seen: continue
+                seen.add(g)
+                members = self.groups[g]
+                target = target_state[e]
+                if all(target_state.get(m) == target for m in members):
+                    result.append(g)
+        return result
+
+    def plan(self, target_state):
+        """Work out the messages to send for target_state.
+
+        Returns the new target state, keyed by group or light, and the
+        number of messages saved compared to sending one per light.
+        """
+        chosen = []
+        for component in self._components(self.candidates(target_state)):
+            chosen.extend(self._pack(component))
+
+        plan = dict(target_state)
+        for g in chosen:
+            members = self.groups[g]
+            target = None
+            for e in members:
+                target = plan.pop(e)
+            plan[g] = target
+
+        return plan, len(target_state) - len(plan)
+
+    def _components(self, candidates):
+        # candidates that don't share a member can be packed independently
+        parent = {g: g for g in candidates}
+
+        def find(g):
+            while parent[g] != g:
+                parent[g] = parent[parent[g]]
+                g = parent[g]
+            return g
+
+        owner = {}
+        for g in candidates:
+            for e in self.groups[g]:
+                if e in owner:
+                    parent[find(g)] = find(owner[e])
+                else:
+                    owner[e] = g
+
+        components = {}
+        for g in candidates:
+            components.setdefault(find(g), []).append(g)
+        return components.values()
+
+    def _pack(self, component):
+        # largest first, so the greedy answer is the old behaviour and the
+        # search finds good plans early
+        component = sorted(component, key = lambda g: len(self.groups[g]), reverse = True)
+        if len(component) > EXACT_SEARCH_LIMIT:
+            return self._pack_greedy(component)
+        return self._pack_exact(component)
+
+    def _pack_greedy(self, component):
+        used = set()
+        chosen = []
+        for g in component:
+            members = self.groups[g]
+            if not(members & used):
+                chosen.append(g)
+                used |= members
+        return chosen
+
+    def _pack_exact(self, component):
+        # a group of n lights saves n - 1 messages; find the disjoint
+        # selection with the biggest saving
+        savings = [len(self.groups[g]) - 1 for g in component]
+        bound = [0] * (len(component) + 1)
+        for i in range(len(component) - 1, -1, -1):
+            bound[i] = bound[i + 1] + savings[i]
+
+        best = [0, []]
+
+        def search(i, used, chosen, saved):
+            if saved > best[0]:
+                best[0], best[1] = saved, list(chosen)
+            if i == len(component) or saved + bound[i] <= best[0]:
+                return
+            members = self.groups[component[i]]
+            if not(members & used):
+                chosen.append(component[i])
+                search(i + 1, used | members, chosen, saved + savings[i])
+                chosen.pop()
+            search(i + 1, used, chosen, saved)
+
+        search(0, frozenset(), [], 0)
+        return best[1]
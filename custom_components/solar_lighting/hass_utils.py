@@ -1,28 +1,40 @@
 # TODO use this later
 """Utility functions for HA core."""
 import logging
-from collections.abc import Awaitable, Callable
+from collections.abc import Awaitable, Callable, Iterable
+from functools import partial
 
-from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.const import ATTR_ENTITY_ID
+from homeassistant.core import HomeAssistant, ServiceCall, callback
 from homeassistant.util.read_only_dict import ReadOnlyDict
 
 from typing import Any
 
 ServiceData = dict[str, Any]
+ServiceRunner = Callable[[Callable[[], Awaitable[None]]], Awaitable[None]]
 
 _LOGGER = logging.getLogger(__name__)
 
+DATA_INTERCEPTOR_HUBS = "solar_lighting_interceptor_hubs"
+
 
 def setup_service_call_interceptor(
     hass: HomeAssistant,
     domain: str,
     service: str,
-    intercept_func: Callable[[ServiceCall, ServiceData], Awaitable[None] | None],
+    intercept_func: Callable[[ServiceCall, ServiceData], Awaitable[ServiceRunner | None]],
+    wants_call: Callable[[ServiceCall], bool] | None = None,
 ) -> Callable[[], None]:
     """Inject a function into a registered service call to preprocess service data.
 
     The injected interceptor function receives the service call and a writeable data dictionary
     (the data of the service call is read-only) before the service call is executed.
+
+    The interceptor may return a runner, which is given the original handler (as a function of
+    no arguments) and is responsible for awaiting it, for example to queue the call.
+
+    If wants_call is given, calls it rejects go straight to the original handler, without the
+    data being copied.
     """
     try:
         # HACK: Access protected attribute of HA service registry.
@@ -45,12 +57,17 @@ def setup_service_call_interceptor(
     existing_service = registered_services[domain][service]
 
     async def service_func_proxy(call: ServiceCall) -> None:
+        if wants_call is not None and not wants_call(call):
+            await existing_service.job.target(call)
+            return
+
+        runner = None
         try:
             # Convert read-only data to writeable dictionary for modification by interceptor
             data = dict(call.data)
 
             # Call interceptor
-            await intercept_func(call, data)
+            runner = await intercept_func(call, data)
 
             # Convert data back to read-only
             call.data = ReadOnlyDict(data)
@@ -61,7 +78,10 @@ def setup_service_call_interceptor(
                 call.data,
             )
         # Call original service handler with processed data
-        await existing_service.job.target(call)
+        if runner:
+            await runner(partial(existing_service.job.target, call))
+        else:
+            await existing_service.job.target(call)
 
     hass.services.async_register(
         domain,
@@ -80,3 +100,84 @@ def setup_service_call_interceptor(
         )
 
     return remove
+
+
+class ServiceCallInterceptorHub:
+    """A single interceptor for a service, shared by many handlers.
+
+    Each handler registers the entity ids it controls, and only sees calls which target at
+    least one of them. Calls targeting none of them are passed on without being copied, so
+    there is one proxy in front of the service however many handlers there are.
+    """
+
+    def __init__(self, hass: HomeAssistant, domain: str, service: str) -> None:
+        self.hass = hass
+        self.domain = domain
+        self.service = service
+        self._index: dict[str, list[Callable]] = {}
+        self._remove: Callable[[], None] | None = None
+
+    def async_register(
+        self,
+        entity_ids: Iterable[str],
+        intercept_func: Callable[[ServiceCall, ServiceData], Awaitable[ServiceRunner | None]],
+    ) -> Callable[[], None]:
+        """Send calls that target any of entity_ids to intercept_func."""
+        entity_ids = list(entity_ids)
+        for entity_id in entity_ids:
+            self._index.setdefault(entity_id, []).append(intercept_func)
+
+        if self._remove is None:
+            self._remove = setup_service_call_interceptor(
+                self.hass, self.domain, self.service, self._async_intercept, self._wants_call
+            )
+
+        def remove():
+            for entity_id in entity_ids:
+                handlers = self._index.get(entity_id)
+                if handlers and intercept_func in handlers:
+                    handlers.remove(intercept_func)
+                    if not handlers:
+                        del self._index[entity_id]
+            if not self._index and self._remove is not None:
+                self._remove()
+                self._remove = None
+
+        return remove
+
+    def _wants_call(self, call: ServiceCall) -> bool:
+        entity_ids = call.data.get(ATTR_ENTITY_ID)
+        if not entity_ids:
+            return False
+        if isinstance(entity_ids, str):
+            return entity_ids in self._index
+        index = self._index
+        return any(entity_id in index for entity_id in entity_ids)
+
+    async def _async_intercept(self, call: ServiceCall, data: ServiceData) -> ServiceRunner | None:
+        entity_ids = data.get(ATTR_ENTITY_ID)
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+
+        handlers = []
+        for entity_id in entity_ids:
+            for handler in self._index.get(entity_id, ()):
+                if handler not in handlers:
+                    handlers.append(handler)
+
+        runner = None
+        for handler in handlers:
+            runner = await handler(call, data) or runner
+        return runner
+
+
+@callback
+def async_get_interceptor_hub(
+    hass: HomeAssistant, domain: str, service: str
+) -> ServiceCallInterceptorHub:
+    """Get the shared interceptor hub for a service, creating it on first use."""
+    hubs = hass.data.setdefault(DATA_INTERCEPTOR_HUBS, {})
+    hub = hubs.get((domain, service))
+    if hub is None:
+        hub = hubs[(domain, service)] = ServiceCallInterceptorHub(hass, domain, service)
+    return hub
@@ -0,0 +1,69 @@
+"""
+Counters and timings for a switch's ticks, shown by the sensor platform.
+
+Timings keep the last WINDOW samples so we can give percentiles; counters
+keep a running total (for HA's statistics) and the value from the last
+tick.
+"""
+from collections import deque
+
+from homeassistant.core import callback
+
+DATA_METRICS = "metrics"
+
+WINDOW = 100
+
+class RollingTiming:
+    def __init__(self, size = WINDOW):
+        self.samples = deque(maxlen = size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+
+    @property
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+    def percentiles(self, *qs):
+        if not(self.samples): return [None for _ in qs]
+        ordered = sorted(self.samples)
+        top = len(ordered) - 1
+        return [ordered[round(q * top)] for q in qs]
+
+class RunningCount:
+    def __init__(self):
+        self.total = 0
+        self.last = 0
+
+    def add(self, value):
+        self.total += value
+        self.last = value
+
+class SwitchMetrics:
+    TIMINGS = ("tick_duration", "interceptor_latency")
+    COUNTS = ("lights_evaluated", "lights_debounced", "lights_deferred",
+              "commands_before_grouping", "commands_after_grouping", "split_turn_ons")
+
+    def __init__(self):
+        for name in self.TIMINGS:
+            setattr(self, name, RollingTiming())
+        for name in self.COUNTS:
+            setattr(self, name, RunningCount())
+        self._listeners = []
+
+    @callback
+    def async_add_listener(self, listener, name = None):
+        """Call listener when the metrics update; with name, only when
+        that metric does"""
+        entry = (name, listener)
+        self._listeners.append(entry)
+        return lambda: self._listeners.remove(entry)
+
+    @callback
+    def async_updated(self, name = None):
+        """Tell the listeners for name, or everyone if it's None"""
+        for (wanted, listener) in self._listeners:
+            if name is None or wanted == name:
+                listener()
@@ -0,0 +1,110 @@
+"""
+The light config, compiled once at setup.
+
+Lights (and groups) with the same settings share one Profile, so a big
+installation holds a handful of profiles rather than a dict of settings
+per light, and the tick loop reads attributes instead of looking up
+string keys.
+"""
+from homeassistant.const import ATTR_ENTITY_ID
+
+SETTINGS = (
+    "brightness_update_delta",
+    "temperature_update_delta",
+    "brightness_adjust",
+    "brightness_min",
+    "brightness_max",
+    "temperature_adjust",
+    "temperature_min",
+    "temperature_max",
+    "brightness_k",
+    "brightness_x",
+    "temperature_k",
+    "temperature_x",
+    "sleep_brightness",
+    "sleep_temperature",
+    "transition",
+    "split_turn_on",
+    "priority",
+)
+
+CURVE_PARAMETERS = ("k", "x", "min", "max")
+
+class Profile:
+    __slots__ = SETTINGS + ("brightness_curve", "temperature_curve")
+
+    def __init__(self, settings):
+        for name in SETTINGS:
+            setattr(self, name, settings.get(name))
+        # what the curve tables are keyed on
+        self.brightness_curve = tuple(settings.get(f"brightness_{p}") for p in CURVE_PARAMETERS)
+        self.temperature_curve = tuple(settings.get(f"temperature_{p}") for p in CURVE_PARAMETERS)
+
+    def curve(self, attr):
+        return self.brightness_curve if attr == "brightness" else self.temperature_curve
+
+class Profiles:
+    def __init__(self):
+        self._profiles = {}
+
+    def intern(self, settings):
+        """The shared profile for these settings"""
+        key = tuple(settings.get(name) for name in SETTINGS)
+        profile = self._profiles.get(key)
+        if profile is None:
+            profile = self._profiles[key] = Profile(settings)
+        return profile
+
+    def __len__(self):
+        return len(self._profiles)
+
+class LightRecord:
+    __slots__ = ("entity_id", "profile", "group")
+
+    def __init__(self, entity_id, profile, group = ()):
+        self.entity_id = entity_id
+        self.profile = profile
+        # for a group, its members' entity ids
+        self.group = group
+
+def with_sleep_defaults(settings):
+    if not(settings.get("sleep_brightness")):
+        settings["sleep_brightness"] = settings.get("brightness_min")
+    if not(settings.get("sleep_temperature")):
+        settings["sleep_temperature"] = settings.get("temperature_min")
+    return settings
+
+def compile_lights(common_config, light_configs, profiles):
+    """Turn the lights: config into records.
+
+    Returns the records for every light and group by entity id, the
+    lights (not groups) in config order, and the groups. A group's
+    members get its settings unless they have their own.
+    """
+    merged = {}
+    groups = []
+
+    for light in light_configs:
+        if isinstance(light, str):
+            light = {**common_config, ATTR_ENTITY_ID: light}
+        else:
+            light = {**common_config, **light}
+        with_sleep_defaults(light)
+
+        entity_id = light.get(ATTR_ENTITY_ID)
+        if light.get("group"):
+            groups.append(entity_id)
+            for sub_id in light.get("group"):
+                merged[sub_id] = {**light,
+                                  **merged.get(sub_id, {ATTR_ENTITY_ID: sub_id}),
+                                  "group": []}
+
+        merged[entity_id] = {**merged.get(entity_id, {}), **light}
+
+    by_id = {
+        entity_id: LightRecord(entity_id, profiles.intern(settings),
+                               tuple(settings.get("group") or ()))
+        for (entity_id, settings) in merged.items()
+    }
+    lights = [record for record in by_id.values() if not(record.group)]
+    return by_id, lights, [by_id[g] for g in dict.fromkeys(groups)]
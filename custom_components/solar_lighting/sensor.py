@@ -0,0 +1,83 @@
+"""
+Sensors for how much work a solar lighting switch is doing.
+
+These are created by the switch platform when `metrics: true`, one set per
+switch, and update after each tick or intercepted call.
+"""
+from homeassistant.components.sensor import SensorEntity, SensorStateClass
+from homeassistant.const import UnitOfTime
+
+from . import DOMAIN
+from .metrics import DATA_METRICS
+
+def setup_platform(hass, config, add_devices, discovery_info = None):
+    if discovery_info is None: return
+    metrics = hass.data[DOMAIN][DATA_METRICS][discovery_info["switch"]]
+    name = discovery_info["name"]
+    object_id = discovery_info["object_id"]
+
+    sensors = [TimingSensor(metrics, name, object_id, key, label)
+               for (key, label) in (("tick_duration", "tick duration"),
+                                    ("interceptor_latency", "interceptor latency"))]
+    sensors += [CountSensor(metrics, name, object_id, key, label)
+                for (key, label) in (("lights_evaluated", "lights evaluated"),
+                                     ("lights_debounced", "lights debounced"),
+                                     ("lights_deferred", "lights deferred"),
+                                     ("commands_before_grouping", "commands before grouping"),
+                                     ("commands_after_grouping", "messages sent"),
+                                     ("split_turn_ons", "split turn ons"))]
+    add_devices(sensors)
+    return True
+
+class MetricSensor(SensorEntity):
+    _attr_should_poll = False
+
+    def __init__(self, metrics, name, object_id, key, label):
+        self._metrics = metrics
+        self._key = key
+        self._name = f"SL {name} {label}"
+        self._entity_id = f"sensor.solar_lighting_{object_id}_{key}"
+
+    @property
+    def icon(self):
+        return "mdi:chart-line"
+
+    @property
+    def entity_id(self):
+        return self._entity_id
+
+    @property
+    def name(self):
+        return self._name
+
+    async def async_added_to_hass(self):
+        self.async_on_remove(self._metrics.async_add_listener(self.async_write_ha_state,
+                                                                 self._key))
+
+class TimingSensor(MetricSensor):
+    _attr_native_unit_of_measurement = UnitOfTime.MILLISECONDS
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    _attr_suggested_display_precision = 2
+
+    @property
+    def native_value(self):
+        median, = getattr(self._metrics, self._key).percentiles(0.5)
+        return median
+
+    @property
+    def extra_state_attributes(self):
+        timing = getattr(self._metrics, self._key)
+        p95, p99, highest = timing.percentiles(0.95, 0.99, 1)
+        return {"last": timing.last, "p95": p95, "p99": p99, "max": highest,
+                "samples": len(timing.samples), "count": timing.count}
+
+class CountSensor(MetricSensor):
+    _attr_state_class = SensorStateClass.TOTAL_INCREASING
+
+    @property
+    def native_value(self):
+        return getattr(self._metrics, self._key).total
+
+    @property
+    def extra_state_attributes(self):
+        return {"last tick": getattr(self._metrics, self._key).last}
@@ -0,0 +1,50 @@
+"""
+What we know about the state of each controlled light.
+
+This is kept up to date from state change events, so a tick doesn't have
+to go to the state machine for every light. Lights whose state has
+changed since they were last evaluated are marked dirty.
+"""
+from homeassistant.components.light import (
+    ATTR_BRIGHTNESS,
+    ATTR_COLOR_TEMP_KELVIN,
+)
+from homeassistant.const import STATE_ON
+
+class LightState:
+    __slots__ = ("on", "brightness", "temperature", "last_changed", "capabilities")
+
+    def __init__(self, state, capabilities):
+        attributes = state.attributes
+        self.on = state.state == STATE_ON
+        self.brightness = attributes.get(ATTR_BRIGHTNESS)
+        self.temperature = attributes.get(ATTR_COLOR_TEMP_KELVIN)
+        self.last_changed = state.last_changed
+        self.capabilities = capabilities
+
+class LightSnapshot:
+    def __init__(self, entity_ids, capabilities):
+        self._states = dict.fromkeys(entity_ids)
+        self._capabilities = capabilities
+        self.dirty = set(self._states)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._states
+
+    def get(self, entity_id):
+        """The LightState for entity_id, or None if it has no state"""
+        return self._states.get(entity_id)
+
+    def update(self, entity_id, state):
+        if entity_id in self._states:
+            self._states[entity_id] = \
+                LightState(state, self._capabilities.update(entity_id, state)) if state else None
+            self.dirty.add(entity_id)
+
+    def mark_dirty(self, entity_ids = None):
+        self.dirty.update(self._states if entity_ids is None else entity_ids)
+
+    def take_dirty(self):
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
@@ -0,0 +1,103 @@
+"""
+Per-day cache of sunrise / noon / sunset.
+
+These only change once a day (or when the HA location is edited), so
+there's no point doing the astral maths on every tick or every
+intercepted turn_on. The cache is keyed on the location and the local
+date, and is refreshed off the event loop at local midnight; until the
+refresh is done (or after a location change) the old times are used.
+"""
+import logging
+import homeassistant.util.dt as dt_util
+
+from homeassistant.core import callback
+from homeassistant.const import EVENT_CORE_CONFIG_UPDATE
+from homeassistant.helpers.sun import get_astral_location
+from homeassistant.helpers.event import async_track_time_change
+
+from . import DOMAIN
+
+log = logging.getLogger(__name__)
+
+DATA_SUN_TIMES = "sun_times"
+
+def fraction_of_day(t):
+    return (t.hour + t.minute / 60) / 24
+
+def compute_sun_times(loc, date):
+    sunrise = loc.sunrise(date)
+    noon = loc.noon(date)
+    sunset = loc.sunset(date)
+    return (fraction_of_day(sunrise), fraction_of_day(noon), fraction_of_day(sunset))
+
+class SunTimes:
+    def __init__(self, hass):
+        self.hass = hass
+        self._key = None
+        self._times = None
+        # the key async_refresh is computing times for, if any
+        self._refreshing = None
+
+    def _current_key(self):
+        config = self.hass.config
+        return (config.latitude, config.longitude, config.elevation,
+                str(config.time_zone), dt_util.now().date())
+
+    @property
+    def times(self):
+        """(sunrise, noon, sunset) for today as fractions of a day.
+
+        This is always a lookup once the cache has been filled: when the
+        day or location changes, the old times are used until a refresh
+        in the executor has the new ones. It only computes if the cache
+        has never been filled, which async_refresh tries to prevent.
+        """
+        key = self._current_key()
+        if key != self._key:
+            if self._times is None:
+                loc, _ = get_astral_location(self.hass)
+                self._times = compute_sun_times(loc, key[-1])
+                self._key = key
+                log.debug("Computed sun times %s for %s", self._times, key)
+            elif key != self._refreshing:
+                self.hass.async_create_task(self.async_refresh())
+        return self._times
+
+    async def async_refresh(self, *args):
+        key = self._current_key()
+        if key == self._key or key == self._refreshing: return
+        self._refreshing = key
+        try:
+            loc, _ = get_astral_location(self.hass)
+            times = await self.hass.async_add_executor_job(compute_sun_times, loc, key[-1])
+        finally:
+            if self._refreshing == key:
+                self._refreshing = None
+        if key != self._current_key():
+            # moved on while we were computing; a newer refresh has it
+            return
+        self._key = key
+        self._times = times
+        log.debug("Refreshed sun times %s for %s", times, key)
+
+    @callback
+    def invalidate(self, *args):
+        self._key = None
+        self.hass.async_create_task(self.async_refresh())
+
+@callback
+def async_get_sun_times(hass):
+    """Get the shared sun times cache, creating it on first use."""
+    data = hass.data.setdefault(DOMAIN, {})
+    sun_times = data.get(DATA_SUN_TIMES)
+    if sun_times is None:
+        sun_times = data[DATA_SUN_TIMES] = SunTimes(hass)
+        hass.bus.async_listen(EVENT_CORE_CONFIG_UPDATE, sun_times.invalidate)
+        async_track_time_change(hass, sun_times.async_refresh,
+                                hour = 0, minute = 0, second = 0)
+    return sun_times
+
+def get_times(hass):
+    now = dt_util.utcnow()
+    sunrise, noon, sunset = async_get_sun_times(hass).times
+    return (fraction_of_day(now), sunrise, noon, sunset)
@@ -1,18 +1,21 @@
 import time
+import math
+import heapq
 import asyncio
+from functools import partial
 import voluptuous as vol
 import datetime
 import logging
 import homeassistant.helpers.config_validation as cv
 import homeassistant.util.dt as dt_util
-from homeassistant.core import Context
+from homeassistant.core import Context, callback
 
-from homeassistant.helpers.sun import get_astral_location
-from homeassistant.helpers.restore_state import RestoreEntity
+from homeassistant.helpers.restore_state import RestoreEntity, RestoredExtraData
 from homeassistant.components.switch import SwitchEntity
 from homeassistant.components.light import DOMAIN as LIGHT_DOMAIN
+from homeassistant.components.sensor import DOMAIN as SENSOR_DOMAIN
+from homeassistant.helpers import discovery
 from homeassistant.util import slugify
-from math import tanh
 from homeassistant.components.light import (
     ATTR_BRIGHTNESS,
     ATTR_BRIGHTNESS_PCT,
@@ -23,14 +26,12 @@ from homeassistant.components.light import (
     ATTR_RGB_COLOR,
     ATTR_TRANSITION,
     ATTR_XY_COLOR,
-    ATTR_COLOR_MODE,
     ATTR_FLASH,
     ATTR_EFFECT,
     ATTR_HS_COLOR,
     ATTR_RGBW_COLOR,
     ATTR_RGBWW_COLOR,
     ATTR_WHITE,
-    ColorMode,
 )
 
 from homeassistant.const import (
@@ -39,19 +40,39 @@ from homeassistant.const import (
     CONF_PLATFORM,
     SERVICE_TURN_ON, SERVICE_TOGGLE,
     STATE_ON,
+    STATE_UNAVAILABLE,
 )
 
 from homeassistant.helpers.event import (
+    async_call_later,
     async_track_time_interval,
+    async_track_point_in_time,
     async_track_state_change_event
 )
 
 from . import DOMAIN
 
-from .hass_utils import setup_service_call_interceptor
+from .hass_utils import async_get_interceptor_hub
+from .sun_times import async_get_sun_times, get_times
+from .curves import curve_tables, minute_of_day, next_change
+from .batch import LightBatch, np
+from .grouping import GroupIndex
+from .dispatch import Dispatcher, PendingCommand, PendingCommands, start_plans
+from .delivery import DELIVERY_TIMEOUT, DELIVERED, MISSED, Deliveries, Delivery
+from .fades import Fade
+from .snapshot import LightSnapshot
+from .capabilities import CapabilityCache, SPLIT_ALWAYS, SPLIT_NEVER, SPLIT_LEARN
+from .metrics import DATA_METRICS, SwitchMetrics
+from . import trace
+from .group_discovery import async_get_group_discovery
+from .coordinator import async_get_tick_coordinator
+from .profiles import SETTINGS, Profiles, compile_lights, with_sleep_defaults
 
 log = logging.getLogger(__name__)
 
+# lights which changed this recently are left until they've settled
+DEBOUNCE = datetime.timedelta(seconds = 1)
+
 brightness = vol.All( vol.Coerce(int), vol.Range(min=1, max=255) )
 color_temp = vol.All( vol.Coerce(int), vol.Range(min=1000, max=10000) )
 
@@ -70,7 +91,9 @@ settings_schema = vol.Schema({
     vol.Optional("temperature_x", default = 0.04): float,
     vol.Optional("sleep_brightness"): brightness,
     vol.Optional("sleep_temperature"): color_temp,
-    vol.Optional("transition", default = 2): cv.positive_int
+    vol.Optional("transition", default = 2): cv.positive_int,
+    vol.Optional("split_turn_on", default = SPLIT_ALWAYS): vol.In([SPLIT_ALWAYS, SPLIT_NEVER, SPLIT_LEARN]),
+    vol.Optional("priority", default = 1.0): cv.positive_float,
 }, extra = vol.ALLOW_EXTRA)
 
 settings_schema_no_defaults = vol.Schema({
@@ -88,34 +111,30 @@ settings_schema_no_defaults = vol.Schema({
     vol.Optional("temperature_x"): float,
     vol.Optional("sleep_brightness"): brightness,
     vol.Optional("sleep_temperature"): color_temp,
-    vol.Optional("transition"): cv.positive_int
+    vol.Optional("transition"): cv.positive_int,
+    vol.Optional("split_turn_on"): vol.In([SPLIT_ALWAYS, SPLIT_NEVER, SPLIT_LEARN]),
+    vol.Optional("priority"): cv.positive_float,
 }, extra = vol.ALLOW_EXTRA)
 
-
-common_keys = [
-    "brightness_update_delta",
-    "temperature_update_delta",
-    "brightness_adjust",
-    "brightness_min",
-    "brightness_max",
-    "temperature_adjust",
-    "temperature_min",
-    "temperature_max",
-    "brightness_k",
-    "brightness_x",
-    "temperature_k",
-    "temperature_x",
-    "sleep_brightness",
-    "sleep_temperature",
-    "transition",
-]
-
 PLATFORM_SCHEMA = vol.All(
     vol.Schema({
         vol.Required(CONF_PLATFORM): "solar_lighting",
         vol.Optional(CONF_NAME, default="Solar Lighting"): cv.string,
         vol.Optional("update_interval", default = datetime.timedelta(seconds = 30)): cv.positive_time_period,
+        vol.Optional("schedule", default = "interval"): vol.In(["interval", "adaptive"]),
         vol.Optional("sleep", default = True): cv.boolean,
+        vol.Optional("batch_evaluation", default = False): cv.boolean,
+        vol.Optional("metrics", default = False): cv.boolean,
+        vol.Optional("discover_groups", default = False): cv.boolean,
+        vol.Optional("max_in_flight", default = 0): cv.positive_int,
+        vol.Optional("split_mode", default = "per_light"): vol.In(["per_light", "batched"]),
+        vol.Optional("message_spacing", default = 0): vol.All(vol.Coerce(float), vol.Range(min = 0)),
+        vol.Optional("message_budget", default = 0): cv.positive_int,
+        vol.Optional("delivery_retries", default = 2): cv.positive_int,
+        vol.Optional("warm_start", default = datetime.timedelta(0)): cv.positive_time_period,
+        vol.Optional("lookahead", default = datetime.timedelta(0)): cv.positive_time_period,
+        vol.Optional("trace_size", default = 1000): cv.positive_int,
+        vol.Optional("shared_tick", default = False): cv.boolean,
         vol.Optional("lights"): vol.Schema([
             vol.Any(
                 cv.entity_id,
@@ -133,6 +152,16 @@ PLATFORM_SCHEMA = vol.All(
 
 def setup_platform(hass, config, add_devices, discovery_info = None):
     main_switch = MainSwitch(hass, config)
+    hass.data.setdefault(DOMAIN, {}).setdefault(trace.DATA_TRACES, {})[main_switch.entity_id] = \
+        main_switch._trace
+    if config.get("metrics"):
+        hass.data.setdefault(DOMAIN, {}).setdefault(DATA_METRICS, {})[main_switch.entity_id] = \
+            main_switch._metrics
+        discovery.load_platform(hass, SENSOR_DOMAIN, DOMAIN,
+                                {"switch": main_switch.entity_id,
+                                 "name": config.get("name"),
+                                 "object_id": slugify(config.get("name"))},
+                                {})
     if config.get("sleep"):
         sleep_switch = SleepSwitch(hass, config, main_switch)
         add_devices( [ main_switch, sleep_switch ] )
@@ -152,56 +181,81 @@ class MainSwitch(SwitchEntity, RestoreEntity):
         self._entity_id = f"switch.solar_lighting_{slugify(name)}"
         self._sleep_mode = None
         self._state = None
-        self._lights = []
-        self._groups = []
         self._update_interval = config.get("update_interval")
+        self._adaptive_schedule = config.get("schedule") == "adaptive"
+        self._unsub_next_update = None
+        self._dispatcher = Dispatcher(hass,
+                                      config.get("max_in_flight"),
+                                      config.get("message_spacing"))
+        self._pending = PendingCommands()
+        self._deliveries = Deliveries()
+        self._delivery_retries = config.get("delivery_retries")
+        self._batched_split = config.get("split_mode") == "batched"
+        self._message_budget = config.get("message_budget")
+        self._unsub_recheck = None
+        self._recheck_at = None
+        self._warm_start = config.get("warm_start")
+        self._warm_start_until = None
+        self._warm_start_budget = None
+        self._lookahead = config.get("lookahead")
+        self._shared_tick = config.get("shared_tick")
+        self._coordinator = None
+        # the fades lights are doing on their own, by light
+        self._fades = {}
+        self._metrics = SwitchMetrics()
+        self._trace = trace.TraceBuffer(config.get("trace_size"))
         self._expected_brightness = {}
         self._expected_temperature = {}
         
         self._manual_brightness = set()
         self._manual_temperature = set()
 
-        self._lights_by_id = {}
-        common_config = {k: config.get(k) for k in common_keys}
-        if common_config.get("temperature_min"):
-            common_config["temperature_min"] = common_config["temperature_min"]
-        if common_config.get("temperature_max"):
-            common_config["temperature_max"] = common_config["temperature_max"]
-
-        for light in config.get("lights", []):
-            if isinstance(light, str):
-                light = {**common_config, ATTR_ENTITY_ID: light}
+        common_config = {k: config.get(k) for k in SETTINGS}
+        profiles = Profiles()
+        # the toplevel settings, for the switch's own attributes
+        self._profile = profiles.intern(with_sleep_defaults(dict(common_config)))
+        self._lights_by_id, self._lights, self._groups = \
+            compile_lights(common_config, config.get("lights", []), profiles)
+        log.debug("%d lights share %d settings profiles", len(self._lights_by_id), len(profiles))
+
+        self._configured_groups = {g.entity_id: g.group for g in self._groups}
+        self._group_index = GroupIndex(self._configured_groups)
+        self._discover_groups = config.get("discover_groups")
+
+        self._batch = None
+        if config.get("batch_evaluation"):
+            if np is None:
+                log.warning("batch_evaluation needs numpy, evaluating lights one at a time")
+            elif self._lookahead:
+                log.warning("batch_evaluation doesn't do lookahead, evaluating lights one at a time")
             else:
-                if light.get("temperature_min"):
-                    light["temperature_min"] = light["temperature_min"]
-                if light.get("temperature_max"):
-                    light["temperature_max"] = light["temperature_max"]
-                light = {**common_config, **light}
-                
-            if not(light.get("sleep_brightness")):
-                light["sleep_brightness"] = light.get("brightness_min")
-            if not(light.get("sleep_temperature")):
-                light["sleep_temperature"] = light.get("temperature_min")
-    
-            if light.get("group"):
-                self._groups.append(light)
-                for sub_id in light.get("group"):
-                    sub_light = {**light,
-                                 **self._lights_by_id.get(sub_id, {ATTR_ENTITY_ID: sub_id}),
-                                 "group":[]}
-                    
-                    self._lights_by_id[sub_id] = sub_light
-
-
-            self._lights_by_id[light.get(ATTR_ENTITY_ID)] = { **self._lights_by_id.get(light.get(ATTR_ENTITY_ID), {}),
-                                                              **light }
-
-        for light in self._lights_by_id.values():
-            if not(light.get("group")):
-                self._lights.append(light)
-        
-        # when we process groups we want to do biggest ones first
-        self._groups.sort(key = lambda g : len(g.get("group", [])), reverse = True)
+                self._batch = LightBatch(self._lights)
+
+        self._capabilities = CapabilityCache()
+        self._snapshot = LightSnapshot(self._lights_by_id, self._capabilities)
+        self._light_index = {light.entity_id: i for (i, light) in enumerate(self._lights)}
+        # which lights follow each curve, so when it moves we know who to look at
+        self._lights_by_curve = {}
+        self._curve_values = {}
+        for (i, light) in enumerate(self._lights):
+            profile = light.profile
+            if profile.brightness_adjust:
+                self._lights_by_curve.setdefault(("brightness", profile.brightness_curve), []).append(i)
+            if profile.temperature_adjust:
+                self._lights_by_curve.setdefault(("temperature", profile.temperature_curve), []).append(i)
+
+        # the distinct (curve, delta) pairs we need to watch to know when
+        # some light's target will next move far enough to need an update
+        self._curve_deltas = set()
+        for profile in {light.profile for light in self._lights}:
+            if profile.brightness_adjust:
+                self._curve_deltas.add((profile.brightness_curve, profile.brightness_update_delta))
+            if profile.temperature_adjust:
+                self._curve_deltas.add((profile.temperature_curve, profile.temperature_update_delta))
+        # the curve's value when we last sent lights on each of those, as
+        # a light that didn't need updating at some wake is still that far
+        # behind at the next
+        self._curve_sent = {}
 
     @property
     def icon(self):
@@ -219,6 +273,37 @@ class MainSwitch(SwitchEntity, RestoreEntity):
     def is_on(self):
         return self._state
 
+    @property
+    def extra_restore_state_data(self):
+        return RestoredExtraData({
+            "expected_brightness": self._expected_brightness,
+            "expected_temperature": self._expected_temperature,
+            "manual_brightness": sorted(self._manual_brightness),
+            "manual_temperature": sorted(self._manual_temperature),
+            "fades": {e: {"origin": fade.origin, "start": fade.start, "end": fade.end,
+                          "started": fade.started.isoformat(),
+                          "finishes": fade.finishes.isoformat()}
+                      for (e, fade) in self._fades.items()},
+        })
+
+    def _restore_data(self, data):
+        # only for lights we still control
+        known = self._lights_by_id
+        self._expected_brightness = {e: v for (e, v) in data.get("expected_brightness", {}).items()
+                                     if e in known}
+        self._expected_temperature = {e: v for (e, v) in data.get("expected_temperature", {}).items()
+                                      if e in known}
+        self._manual_brightness = {e for e in data.get("manual_brightness", ()) if e in known}
+        self._manual_temperature = {e for e in data.get("manual_temperature", ()) if e in known}
+        # the lights carry on with their fades while we're restarting
+        self._fades = {e: Fade(fade["origin"], fade["start"], fade["end"],
+                               dt_util.parse_datetime(fade["started"]),
+                               dt_util.parse_datetime(fade["finishes"]))
+                       for (e, fade) in data.get("fades", {}).items() if e in known}
+        log.debug("Restored %d manual overrides and %d expectations",
+                  len(self._manual_brightness) + len(self._manual_temperature),
+                  len(self._expected_brightness) + len(self._expected_temperature))
+
     @property
     def extra_state_attributes(self):
         return {**self._extra_attributes,
@@ -227,154 +312,667 @@ class MainSwitch(SwitchEntity, RestoreEntity):
                 }
 
     async def update_lights(self, *args):
-        if not(self._state): return
-
-        times = get_times(self.hass)
+        await self._async_run_tick(full = True)
 
+    async def _async_run_tick(self, full):
+        """Run a tick. The tick itself never awaits (commands go out in
+        the background), so two can't overlap however they're asked for."""
+        if self._coordinator:
+            await self._coordinator.async_run_tick(full)
+            return
+        self._tick(full)
+
+    async def async_wait_sent(self):
+        """Wait for the commands started so far to finish"""
+        tasks = self._pending.tasks()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def _tick(self, full = True):
+        started = time.perf_counter()
+        prepared = self._prepare_tick(get_times(self.hass), full)
+        if prepared is None: return
+        target_state, needs_update, waves, wave_delay = prepared
+
+        plans = [self._group_index.plan(wave)[0] for wave in waves]
+        commands = []
+        wanted = {}
+        for (wave, plan) in enumerate(plans):
+            for (entity_id, state) in plan.items():
+                state[ATTR_ENTITY_ID] = entity_id
+                wanted.setdefault(entity_id, []).append(state)
+                commands.append((wave, entity_id, state, self._group_members(entity_id)))
+        self._record_commands(target_state, waves, commands)
+
+        # anything else still pending for these lights is stale now
+        self._supersede(needs_update, retargeted = needs_update, wanted = wanted)
+        start_plans(self.hass, plans, wave_delay, self._start_planned)
+        self._record_tick(started)
+
+    def _prepare_tick(self, times, full):
+        """Work out this tick's targets and set what we expect of the
+        lights. Returns the targets, the lights being updated, the targets
+        split into waves and the delay between them; or None if we're off.
+        Grouping and sending are left to the caller."""
+        if not(self._state): return None
+
+        metrics = self._metrics
         self._extra_attributes[ATTR_BRIGHTNESS] = \
             evaluate_brightness(self._sleep_mode,
                                 times,
-                                self._config)
+                                self._profile)
         self._extra_attributes[ATTR_COLOR_TEMP_KELVIN] = \
             evaluate_temperature(self._sleep_mode,
                                  times,
-                                 self._config)
+                                 self._profile)
         
-        target_state = {}
-        needs_update = set()
+        indices, debounced = self._lights_to_evaluate(times, full)
+        metrics.lights_evaluated.add(len(indices))
+        metrics.lights_debounced.add(debounced)
+        fades = {}
+        if self._batch:
+            target_state, needs_update = self._evaluate_lights_batched(times, indices)
+        else:
+            target_state, needs_update = self._evaluate_lights(times, indices, fades)
+
+        deferred = self._over_budget(target_state)
+        for entity_id in deferred:
+            del target_state[entity_id]
+            needs_update.discard(entity_id)
+        # look at them again next tick
+        self._snapshot.mark_dirty(deferred)
+        metrics.lights_deferred.add(len(deferred))
+        self._extra_attributes["Deferred updates"] = len(deferred)
+
+        if self._adaptive_schedule:
+            self._remember_sent(times, target_state, needs_update)
+            wake = self._next_update_time(times)
+            if deferred:
+                wake = min(wake, dt_util.utcnow() + self._update_interval)
+            self._schedule_update(wake)
+
+        for (entity_id, state) in target_state.items():
+            if entity_id in needs_update:
+                if ATTR_BRIGHTNESS in state:
+                    self._expected_brightness[entity_id] = state[ATTR_BRIGHTNESS]
+                if ATTR_COLOR_TEMP_KELVIN in state:
+                    self._expected_temperature[entity_id] = state[ATTR_COLOR_TEMP_KELVIN]
+                if entity_id in fades:
+                    self._fades[entity_id] = fades[entity_id]
+                else:
+                    self._fades.pop(entity_id, None)
+                self._trace.record(trace.TARGET, entity_id,
+                                   state.get(ATTR_BRIGHTNESS), state.get(ATTR_COLOR_TEMP_KELVIN))
 
+        if self._batched_split:
+            waves, wave_delay = self._split_waves(target_state)
+        else:
+            waves, wave_delay = [target_state], 0
+        return target_state, needs_update, waves, wave_delay
+
+    def _record_commands(self, target_state, waves, commands):
+        # commands are (wave, key, target, covered) for what this switch is
+        # sending this tick
+        metrics = self._metrics
+        for (wave, entity_id, state, covered) in commands:
+            if covered != (entity_id,):
+                self._trace.record(trace.GROUPED, entity_id,
+                                   state.get(ATTR_BRIGHTNESS), state.get(ATTR_COLOR_TEMP_KELVIN))
+        self._extra_attributes["Messages saved by grouping"] = \
+            sum(len(wave) for wave in waves) - len(commands)
+        metrics.commands_before_grouping.add(len(target_state))
+        metrics.commands_after_grouping.add(len(commands))
+        # a second wave is the brightness half of a split
+        metrics.split_turn_ons.add(sum(1 for (wave, entity_id, state, covered) in commands
+                                       if wave or self._split_mode(entity_id, state, covered) == "split"))
+
+    def _record_tick(self, started):
+        self._metrics.tick_duration.add((time.perf_counter() - started) * 1000)
+        self._metrics.async_updated()
+
+    def _over_budget(self, target_state):
+        """The lights to leave for a later tick, when grouping target_state
+        takes more commands than message_budget allows. Commands are ranked
+        by their furthest light from target, so the closest go last."""
+        budget = self._message_budget
+        if self._warm_start_until:
+            budget = self._warm_start_limit(target_state, budget)
+        if not(budget) or len(target_state) <= budget:
+            return []
+        plan, _ = self._group_index.plan(target_state)
+        if len(plan) <= budget:
+            return []
+
+        errors = {e: self._update_error(e, state) for (e, state) in target_state.items()}
+        keep = heapq.nlargest(budget, plan,
+                              key = lambda g: max(errors.get(e, 0) for e in self._group_members(g)))
+        kept = {e for g in keep for e in self._group_members(g)}
+        deferred = [e for e in target_state if e not in kept]
+        for e in deferred:
+            self._trace.record(trace.DEFERRED, e)
+        return deferred
+
+    def _warm_start_limit(self, target_state, budget):
+        # after a restart, spread the first catch up over the warm_start
+        # window rather than sending it all while the mesh is coming up
+        if dt_util.utcnow() >= self._warm_start_until:
+            self._warm_start_until = None
+            return budget
+        if self._warm_start_budget is None:
+            if not(target_state): return budget
+            plan, _ = self._group_index.plan(target_state)
+            ticks = max(1, self._warm_start / self._update_interval)
+            self._warm_start_budget = math.ceil(len(plan) / ticks)
+            log.info("Warm start: %d commands, at most %d a tick", len(plan), self._warm_start_budget)
+        return min(budget, self._warm_start_budget) if budget else self._warm_start_budget
+
+    def _update_error(self, entity_id, state):
+        # how far a light is from its target, in update deltas, times its priority
+        profile = self._lights_by_id[entity_id].profile
+        current = self._snapshot.get(entity_id)
+        capabilities = current.capabilities
+        error = 0
+        for (attr, value, delta, supported) in (
+                (ATTR_BRIGHTNESS, current.brightness,
+                 profile.brightness_update_delta, capabilities.supports_brightness),
+                (ATTR_COLOR_TEMP_KELVIN, current.temperature,
+                 profile.temperature_update_delta, capabilities.supports_temperature)):
+            if attr in state and supported:
+                if not(value):
+                    # don't know where it is, so it goes first
+                    return math.inf
+                error = max(error, abs(state[attr] - value) / delta)
+        return error * profile.priority
+
+    def _group_members(self, entity_id):
+        return self._group_index.members.get(entity_id) or (entity_id,)
+
+    @callback
+    def _update_discovered_groups(self):
+        # a discovered group is only any use if we control all its members
+        groups = dict(self._configured_groups)
+        discovered = []
+        for (group, members) in async_get_group_discovery(self.hass).groups.items():
+            if group in self._lights_by_id or group in groups: continue
+            if all(e in self._light_index for e in members):
+                groups[group] = members
+                discovered.append(group)
+        if discovered:
+            log.info("Using discovered groups %s", discovered)
+        self._group_index = GroupIndex(groups)
+        self._extra_attributes["Discovered groups"] = discovered
+        if self._coordinator:
+            self._coordinator.async_groups_changed()
+
+    def _split_waves(self, target_state):
+        # like async_split_turn_on, but for every light at once: lights
+        # that need the tradfri split get temperature in the first wave and
+        # brightness in the second, everything else (including lights
+        # we're trying a combined change on) goes in the first.
+        first = {}
+        second = {}
+        delay = 0
+        for (entity_id, state) in target_state.items():
+            if self._split_mode(entity_id, state) == "split":
+                transition = state[ATTR_TRANSITION] / 2
+                first[entity_id] = {ATTR_COLOR_TEMP_KELVIN: state[ATTR_COLOR_TEMP_KELVIN],
+                                    ATTR_TRANSITION: transition}
+                second[entity_id] = {ATTR_BRIGHTNESS: state[ATTR_BRIGHTNESS],
+                                     ATTR_TRANSITION: transition}
+                delay = max(delay, 0.5 + transition)
+            else:
+                first[entity_id] = dict(state)
+        return [first, second], delay
+
+    def _split_mode(self, entity_id, state, covered = None):
+        """How to send state to entity_id: "split" for the tradfri split,
+        "probe" to try it combined and see if that works, or "combined"."""
+        if not(needs_split(state)):
+            return "combined"
+        covered = covered or self._group_members(entity_id)
+        unknown = False
+        for e in covered:
+            owner = self._owner(e)
+            light = owner._lights_by_id.get(e)
+            setting = light.profile.split_turn_on if light else SPLIT_ALWAYS
+            if setting == SPLIT_ALWAYS:
+                return "split"
+            if setting == SPLIT_LEARN:
+                simultaneous = owner._capabilities.simultaneous(e)
+                if simultaneous is False:
+                    return "split"
+                unknown = unknown or simultaneous is None
+        if unknown:
+            # only learn from lights on their own, not groups
+            return "probe" if len(covered) == 1 else "split"
+        return "combined"
+
+    def _owner(self, entity_id):
+        """The switch which controls entity_id: us, unless a shared tick
+        has us sending a group that reaches into another switch's lights"""
+        if self._coordinator is None or entity_id in self._light_index:
+            return self
+        return self._coordinator.owner(entity_id) or self
+
+    def _start_planned(self, entity_id, state, after, covered = None, sharers = ()):
+        covered = covered or self._group_members(entity_id)
+        if self._pending.is_pending(entity_id, covered, state):
+            return None
+        return self._start_command(entity_id, covered, state, after, sharers = sharers)
+
+    def _start_command(self, entity_id, covered, state, after = None, attempt = 0, sharers = ()):
+        # sharers are the other switches with lights in covered; they
+        # need to know it's pending too
+        command = PendingCommand(entity_id, dict(state), covered)
+        mode = "combined" if after is not None else self._split_mode(entity_id, state, covered)
+        if mode != "probe" and self._delivery_retries:
+            before = {e: self._owner(e)._snapshot.get(e) for e in covered}
+        if mode == "split":
+            command.task = self.hass.async_create_task(
+                self.async_split_turn_on(state, command.unsent)
+            )
+        elif mode == "probe":
+            command.task = self.hass.async_create_task(
+                self._async_probe_turn_on(entity_id, state, command.unsent)
+            )
+        else:
+            command.task = self.hass.async_create_task(
+                self._async_turn_on(state, command.unsent, after)
+            )
+        self._pending.add(command)
+        for switch in sharers:
+            switch._pending.add(command)
+        if mode != "probe" and self._delivery_retries:
+            command.task.add_done_callback(
+                partial(self._command_sent, command, before, attempt)
+            )
+        return command.task
+
+    @callback
+    def _command_sent(self, command, before, attempt, task):
+        # check on each light once it's had time to get there
+        if task.cancelled() or task.exception() or not(self._state): return
+        target = {attr: value for (attr, value) in command.target.items()
+                  if attr in (ATTR_BRIGHTNESS, ATTR_COLOR_TEMP_KELVIN)}
+        if not(target): return
+        deliveries = {}
+        fading = False
+        for e in command.covered:
+            # each light is checked by the switch controlling it
+            owner = self._owner(e)
+            if not(owner._delivery_retries): continue
+            delivery = Delivery(target, before.get(e), attempt)
+            owner._deliveries.watch(e, delivery)
+            deliveries.setdefault(owner, []).append((e, delivery))
+            fading = fading or e in owner._fades
+        if fading:
+            # a fade takes a while, but the light should be on its way
+            delay = DELIVERY_TIMEOUT
+        else:
+            delay = command.target.get(ATTR_TRANSITION, 0) + DELIVERY_TIMEOUT
+        for (owner, watched) in deliveries.items():
+            async_call_later(self.hass, delay, partial(owner._check_deliveries, watched))
+
+    @callback
+    def _check_deliveries(self, deliveries, now):
+        recheck = False
+        for (entity_id, delivery) in deliveries:
+            if not(self._deliveries.take(entity_id, delivery)): continue
+            # it was skipped by ticks while we waited
+            self._snapshot.mark_dirty([entity_id])
+            current = self._snapshot.get(entity_id)
+            if not(current and current.on): continue
+            profile = self._lights_by_id[entity_id].profile
+            outcome, missing = delivery.outcome(current, profile)
+            if outcome == DELIVERED:
+                continue
+            if outcome != MISSED:
+                # someone else changed it; the manual change check decides
+                log.debug("%s changed to something else after %s", entity_id, delivery.target)
+                recheck = True
+                continue
+            if self._fades.pop(entity_id, None):
+                # start a new fade from where it is next tick, rather than
+                # resending one that's already under way
+                log.info("%s missed the fade to %s", entity_id, missing)
+                self._forget_expectations(entity_id, missing)
+                recheck = True
+                continue
+            if delivery.attempt < self._delivery_retries and \
+               not(self._pending.unsent(entity_id)):
+                log.info("%s missed %s, sending it again", entity_id, missing)
+                self._trace.record(trace.MISSED, entity_id,
+                                   missing.get(ATTR_BRIGHTNESS), missing.get(ATTR_COLOR_TEMP_KELVIN))
+                missing[ATTR_TRANSITION] = profile.transition or 0
+                missing[ATTR_ENTITY_ID] = entity_id
+                self._start_command(entity_id, (entity_id,), missing,
+                                    attempt = delivery.attempt + 1)
+            else:
+                # not a manual change, so let a later tick try again
+                log.warning("%s still hasn't got %s, giving up for now", entity_id, missing)
+                self._forget_expectations(entity_id, missing)
+                recheck = True
+        if recheck:
+            # the lights are dirty, but an adaptive schedule might not tick
+            # for hours; not straight away, or a light that keeps missing
+            # would be sent to over and over
+            self._schedule_recheck(self._update_interval.total_seconds())
+
+    def _forget_expectations(self, entity_id, attributes):
+        if ATTR_BRIGHTNESS in attributes:
+            self._expected_brightness.pop(entity_id, None)
+        if ATTR_COLOR_TEMP_KELVIN in attributes:
+            self._expected_temperature.pop(entity_id, None)
+
+    def _supersede(self, entity_ids, retargeted = (), wanted = None):
+        # a cancelled command may have gone out partly or not at all, so
+        # forget what we expected of its lights for the attributes it
+        # didn't send; otherwise the next tick would think they'd been
+        # changed by hand. Lights in retargeted are getting new expectations.
+        self._cancelled(self._pending.supersede(entity_ids, wanted), retargeted)
+
+    def _cancelled(self, commands, retargeted = ()):
+        for command in commands:
+            log.debug("Cancel superseded command %s", command.target)
+            for e in command.covered:
+                if e in retargeted: continue
+                owner = self._owner(e)
+                owner._snapshot.mark_dirty([e])
+                owner._schedule_recheck(0)
+                owner._forget_expectations(e, command.unsent)
+                if command.unsent:
+                    owner._fades.pop(e, None)
+
+    def _remember_sent(self, times, target_state, needs_update):
+        if self._sleep_mode or not(needs_update): return
+        _, sunrise, noon, sunset = times
+        minute = minute_of_day(times[0])
+        for entity_id in needs_update:
+            profile = self._lights_by_id[entity_id].profile
+            state = target_state[entity_id]
+            for (attr, curve, delta) in (
+                    (ATTR_BRIGHTNESS, profile.brightness_curve, profile.brightness_update_delta),
+                    (ATTR_COLOR_TEMP_KELVIN, profile.temperature_curve, profile.temperature_update_delta)):
+                if attr in state:
+                    table = curve_tables.table((sunrise, noon, sunset), *curve)
+                    self._curve_sent[(curve, delta)] = table[minute]
+
+    def _next_update_time(self, times):
+        # times are in fractions of a UTC day (see get_times), and the
+        # curve tables wrap at UTC midnight; the sun times themselves move
+        # at local midnight, so we always wake for both.
         now = dt_util.utcnow()
-        debounce = datetime.timedelta(seconds = 1)
+        utc_day = now.replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+        one_day = datetime.timedelta(days = 1)
+        wake = min(utc_day + one_day, dt_util.start_of_local_day() + one_day)
+
+        if not(self._sleep_mode):
+            _, sunrise, noon, sunset = times
+            minute = minute_of_day(times[0])
+            for (profile, delta) in self._curve_deltas:
+                table = curve_tables.table((sunrise, noon, sunset), *profile)
+                # from what we last sent, unless that's already out and the
+                # lights were left alone (manual), when it's from now
+                sent = self._curve_sent.get((profile, delta))
+                if sent is not None and abs(table[minute] - sent) > delta:
+                    sent = None
+                change = next_change(table, minute, delta, sent)
+                if change is not None:
+                    wake = min(wake, utc_day + datetime.timedelta(minutes = change))
+
+        return max(wake, now + datetime.timedelta(seconds = 1))
+
+    def _schedule_update(self, when):
+        self._cancel_scheduled_update()
+        log.debug("Next update for %s at %s", self._entity_id, when)
+        self._unsub_next_update = async_track_point_in_time(
+            self.hass, self._scheduled_update, when
+        )
+
+    def _cancel_scheduled_update(self):
+        if self._unsub_next_update:
+            self._unsub_next_update()
+            self._unsub_next_update = None
 
-        for light in self._lights:
-            entity_id = light.get(ATTR_ENTITY_ID)
-            state = self.hass.states.get(entity_id)
+    async def _scheduled_update(self, now):
+        self._unsub_next_update = None
+        await self.update_lights()
+
+    def _lights_to_evaluate(self, times, full = True):
+        # only lights whose state has changed, or whose curve has moved
+        # since the last tick, can have anything new to do. A tick which
+        # isn't full just looks at the changed ones.
+        selected = {self._light_index[e] for e in self._snapshot.take_dirty()
+                    if e in self._light_index}
+
+        if full and not(self._sleep_mode):
+            _, sunrise, noon, sunset = times
+            minute = minute_of_day(times[0])
+            for ((attr, profile), indices) in self._lights_by_curve.items():
+                value = curve_tables.table((sunrise, noon, sunset), *profile)[minute]
+                if self._curve_values.get((attr, profile)) != value:
+                    self._curve_values[(attr, profile)] = value
+                    selected.update(indices)
 
-            if state and (now - state.last_changed) < debounce:
-                log.info("Skip %s as it has a very recent state change", entity_id)
+        now = dt_util.utcnow()
+        indices = []
+        debounced = []
+        for i in sorted(selected):
+            entity_id = self._lights[i].entity_id
+            if entity_id in self._deliveries:
+                # we're waiting to see if it got the last command
                 continue
+            state = self._snapshot.get(entity_id)
+            if state and (now - state.last_changed) < DEBOUNCE:
+                self._trace.record(trace.DEBOUNCED, entity_id)
+                debounced.append(entity_id)
+            else:
+                indices.append(i)
+        # look at them again once they've settled
+        self._snapshot.mark_dirty(debounced)
+        if debounced:
+            settled = max(self._snapshot.get(e).last_changed for e in debounced) + DEBOUNCE
+            self._schedule_recheck((settled - now).total_seconds())
+
+        return indices, len(debounced)
+
+    def _schedule_recheck(self, delay):
+        # a partial tick for the dirty lights; an earlier one already
+        # scheduled will do
+        when = self.hass.loop.time() + delay
+        if self._unsub_recheck and self._recheck_at <= when: return
+        self._cancel_recheck()
+        self._recheck_at = when
+        self._unsub_recheck = async_call_later(self.hass, delay, self._async_recheck)
+
+    def _cancel_recheck(self):
+        if self._unsub_recheck:
+            self._unsub_recheck()
+            self._unsub_recheck = None
+
+    async def _async_recheck(self, now):
+        self._unsub_recheck = None
+        await self._async_run_tick(full = False)
+
+    def _evaluate_lights(self, times, indices, fades):
+        # fades is filled in with the fades to start, for lights being
+        # sent a lookahead target
+        target_state = {}
+        needs_update = set()
+        # fades follow the curve, which get_times reads in whole minutes
+        now = dt_util.utcnow().replace(second = 0, microsecond = 0)
 
-            if state and state.state == STATE_ON:
+        for i in indices:
+            light = self._lights[i]
+            entity_id = light.entity_id
+            profile = light.profile
+            state = self._snapshot.get(entity_id)
+
+            if state and state.on:
                 update = {}
-                cur_brightness = state.attributes.get(ATTR_BRIGHTNESS)
-                cur_temperature = state.attributes.get(ATTR_COLOR_TEMP_KELVIN)
+                cur_brightness = state.brightness
+                cur_temperature = state.temperature
                 
-                ex_brightness = self._expected_brightness.get(entity_id, cur_brightness)
-                ex_temperature = self._expected_temperature.get(entity_id, cur_temperature)
+                # no point checking for manual changes to something we're
+                # still in the middle of sending
+                unsent = self._pending.unsent(entity_id)
+                ex_brightness = cur_brightness if ATTR_BRIGHTNESS in unsent else \
+                    self._expected_brightness.get(entity_id, cur_brightness)
+                ex_temperature = cur_temperature if ATTR_COLOR_TEMP_KELVIN in unsent else \
+                    self._expected_temperature.get(entity_id, cur_temperature)
                 
-                brightness_delta = light.get("brightness_update_delta")
-                temperature_delta = light.get("temperature_update_delta")
-
-                cmode = state.attributes.get(ATTR_COLOR_MODE)
-
-                if cmode == ColorMode.BRIGHTNESS:
-                    supports_brightness = True
-                    supports_temperature = False
-                elif cmode == ColorMode.ONOFF:
-                    supports_brightness = False
-                    supports_temperature = False
-                else:
-                    supports_brightness = True
-                    supports_temperature = True
-                    
-                if cur_brightness and abs(ex_brightness - cur_brightness) > brightness_delta:
+                brightness_delta = profile.brightness_update_delta
+                temperature_delta = profile.temperature_update_delta
+
+                capabilities = state.capabilities
+                supports_brightness = capabilities.supports_brightness
+                supports_temperature = capabilities.supports_temperature
+
+                # during a fade the light is wherever it's got to on the way,
+                # which is what to compare the curve with
+                fade = self._fades.get(entity_id)
+                if fade and fade.finished(now):
+                    del self._fades[entity_id]
+                    fade = None
+                fading_brightness = fade and ATTR_BRIGHTNESS in fade
+                fading_temperature = fade and ATTR_COLOR_TEMP_KELVIN in fade
+
+                if cur_brightness and abs(ex_brightness - cur_brightness) > brightness_delta and \
+                   not(fading_brightness and fade.covers(ATTR_BRIGHTNESS, cur_brightness, brightness_delta)):
                     self.set_manual_brightness(entity_id)
                     
-                if cur_temperature and abs(ex_temperature - cur_temperature) > temperature_delta:
+                if cur_temperature and abs(ex_temperature - cur_temperature) > temperature_delta and \
+                   not(fading_temperature and fade.covers(ATTR_COLOR_TEMP_KELVIN, cur_temperature, temperature_delta)):
                     self.set_manual_temperature(entity_id)
 
-                if entity_id not in self._manual_brightness and light.get("brightness_adjust"):
-                    brightness = evaluate_brightness(self._sleep_mode, times, light)
+                if fading_brightness:
+                    cur_brightness = fade.value(ATTR_BRIGHTNESS, now)
+                if fading_temperature:
+                    cur_temperature = fade.value(ATTR_COLOR_TEMP_KELVIN, now)
+
+                # a light isn't sent what it can't do, so that it doesn't
+                # cost a split or stop a group matching for nothing
+                if entity_id not in self._manual_brightness and profile.brightness_adjust and \
+                   supports_brightness:
+                    brightness = evaluate_brightness(self._sleep_mode, times, profile)
                     update[ATTR_BRIGHTNESS] = brightness
                     if not(cur_brightness) or abs(cur_brightness - brightness) > brightness_delta:
-                        if supports_brightness:
-                            needs_update.add(entity_id)
+                        needs_update.add(entity_id)
 
-                if entity_id not in self._manual_temperature and light.get("temperature_adjust"):
-                    temperature = evaluate_temperature(self._sleep_mode, times, light)
+                if entity_id not in self._manual_temperature and profile.temperature_adjust and \
+                   supports_temperature:
+                    temperature = capabilities.clamp_kelvin(
+                        evaluate_temperature(self._sleep_mode, times, profile)
+                    )
                     update[ATTR_COLOR_TEMP_KELVIN] = temperature
                     if not(cur_temperature) or abs(cur_temperature - temperature) > temperature_delta:
-                        if supports_temperature:
-                            needs_update.add(entity_id)
+                        needs_update.add(entity_id)
 
                 if entity_id in needs_update:
-                    update[ATTR_TRANSITION] = light.get("transition", 0)
+                    update[ATTR_TRANSITION] = profile.transition or 0
+                    if self._lookahead and not(self._sleep_mode):
+                        update = self._look_ahead(entity_id, update, state, times, now, fades)
                     target_state[entity_id] = update
             else:
                 self.clear_overrides_and_expectations(entity_id)
-                
-        for (entity_id, state) in target_state.items():
-            if entity_id in needs_update:
-                if ATTR_BRIGHTNESS in state:
-                    self._expected_brightness[entity_id] = state[ATTR_BRIGHTNESS]
-                if ATTR_COLOR_TEMP_KELVIN in state:
-                    self._expected_temperature[entity_id] = state[ATTR_COLOR_TEMP_KELVIN]
 
-        if target_state:
-            log.info("Before grouping: %s", target_state)
-        
-        for group in self._groups:
-            members = group.get("group")
-            member_needs_update = False
-            for e in members:
-                if e in needs_update and e in target_state:
-                    member_needs_update = True
-                    break
-
-            if member_needs_update:
-                targets = [target_state.get(e, None) for e in members]
-                log.info("Maybe update group %s %s %s", group.get(ATTR_ENTITY_ID),
-                             members, targets)
-
-                if all_equal(targets):
-                    # remove from target_state
-                    log.info("Target state for group %s is consistent at %s",
-                                 group.get(ATTR_ENTITY_ID), targets[0])
-
-                    for e in members:
-                        target_state.pop(e, None)
-                    if targets[0]:
-                        target_state[group.get(ATTR_ENTITY_ID)] = targets[0]
-
-        if target_state:
-            log.info("After grouping: %s", target_state)
-            
-        turn_ons = []
-        for (entity_id, state) in target_state.items():
-            state[ATTR_ENTITY_ID] = entity_id
-            if ATTR_TRANSITION in state \
-               and state[ATTR_TRANSITION] > 0 \
-               and ATTR_BRIGHTNESS in state \
-               and ATTR_COLOR_TEMP_KELVIN in state:
-                turn_ons.append(
-                    self.hass.async_create_task( self.async_split_turn_on( state ) )
-                )
+        return target_state, needs_update
+
+    def _look_ahead(self, entity_id, update, state, times, now, fades):
+        # send where the curve will be in lookahead's time, and let the
+        # light fade there
+        profile = self._lights_by_id[entity_id].profile
+        lookahead = self._lookahead.total_seconds()
+        ahead = (times[0] + lookahead / 86400, *times[1:])
+        origin = {}
+        start = {}
+        end = {}
+        if ATTR_BRIGHTNESS in update:
+            origin[ATTR_BRIGHTNESS] = state.brightness
+            start[ATTR_BRIGHTNESS] = update[ATTR_BRIGHTNESS]
+            end[ATTR_BRIGHTNESS] = evaluate_brightness(False, ahead, profile)
+        if ATTR_COLOR_TEMP_KELVIN in update:
+            origin[ATTR_COLOR_TEMP_KELVIN] = state.temperature
+            start[ATTR_COLOR_TEMP_KELVIN] = update[ATTR_COLOR_TEMP_KELVIN]
+            end[ATTR_COLOR_TEMP_KELVIN] = \
+                state.capabilities.clamp_kelvin(evaluate_temperature(False, ahead, profile))
+        faded = {**end, ATTR_TRANSITION: lookahead}
+        # a fade needs to know where the light starts, and a light which
+        # needs the tradfri split can't do a long one
+        if None in origin.values() or self._split_mode(entity_id, faded) != "combined":
+            return update
+        fades[entity_id] = Fade(origin, start, end, now, now + self._lookahead)
+        return faded
+
+    def _evaluate_lights_batched(self, times, indices):
+        # same as _evaluate_lights, but we only gather state here and
+        # leave the arithmetic to numpy
+        batch = self._batch
+        current = batch.new_state()
+
+        for i in indices:
+            entity_id = self._lights[i].entity_id
+            state = self._snapshot.get(entity_id)
+
+            if state and state.on:
+                current["active"][i] = True
+                current["brightness"][i] = state.brightness or float("nan")
+                current["temperature"][i] = state.temperature or float("nan")
+                unsent = self._pending.unsent(entity_id)
+                if ATTR_BRIGHTNESS not in unsent:
+                    current["expected_brightness"][i] = self._expected_brightness.get(entity_id, float("nan"))
+                if ATTR_COLOR_TEMP_KELVIN not in unsent:
+                    current["expected_temperature"][i] = self._expected_temperature.get(entity_id, float("nan"))
+                current["manual_brightness"][i] = entity_id in self._manual_brightness
+                current["manual_temperature"][i] = entity_id in self._manual_temperature
+                capabilities = state.capabilities
+                current["supports_brightness"][i] = capabilities.supports_brightness
+                current["supports_temperature"][i] = capabilities.supports_temperature
+                if capabilities.min_kelvin:
+                    current["min_kelvin"][i] = capabilities.min_kelvin
+                if capabilities.max_kelvin:
+                    current["max_kelvin"][i] = capabilities.max_kelvin
             else:
-                turn_ons.append(
-                    self.hass.async_create_task(
-                        self.hass.services.async_call(
-                            LIGHT_DOMAIN, SERVICE_TURN_ON, state, context=self.context
-                        )
-                    )
-                )
-        if turn_ons:
-            await asyncio.wait(turn_ons)
+                self.clear_overrides_and_expectations(entity_id)
+
+        result = batch.evaluate(self._sleep_mode, times, current)
+
+        for i in result["went_manual_brightness"]:
+            self.set_manual_brightness(self._lights[i].entity_id)
+        for i in result["went_manual_temperature"]:
+            self.set_manual_temperature(self._lights[i].entity_id)
+
+        target_state = {}
+        for i in result["needs_update"]:
+            light = self._lights[i]
+            update = {}
+            if result["include_brightness"][i]:
+                update[ATTR_BRIGHTNESS] = int(result["brightness"][i])
+            if result["include_temperature"][i]:
+                update[ATTR_COLOR_TEMP_KELVIN] = int(result["temperature"][i])
+            update[ATTR_TRANSITION] = light.profile.transition or 0
+            target_state[light.entity_id] = update
+
+        return target_state, set(target_state)
 
     def set_manual_brightness(self, entity_id):
         if entity_id not in self._manual_brightness:
             log.info("%s -> manual brightness", entity_id)
+            self._trace.record(trace.MANUAL_BRIGHTNESS, entity_id)
             self._manual_brightness.update(
-                self._lights_by_id.get(entity_id, {}).get("group") or [entity_id]
+                self._group_members(entity_id)
             )
 
     def set_manual_temperature(self, entity_id):
         if entity_id not in self._manual_temperature:
             log.info("%s -> manual temperature", entity_id)
+            self._trace.record(trace.MANUAL_TEMPERATURE, entity_id)
             self._manual_temperature.update(
-                self._lights_by_id.get(entity_id, {}).get("group") or [entity_id]
+                self._group_members(entity_id)
             )
             
-    async def async_split_turn_on(self, state):
+    async def async_split_turn_on(self, state, unsent = None):
+        unsent = set() if unsent is None else unsent
         brightness_only = state.copy()
         del brightness_only[ATTR_COLOR_TEMP_KELVIN]
         del state[ATTR_BRIGHTNESS]
@@ -382,42 +980,103 @@ class MainSwitch(SwitchEntity, RestoreEntity):
         transition = brightness_only[ATTR_TRANSITION] / 2
         brightness_only[ATTR_TRANSITION] = transition
         state[ATTR_TRANSITION] = transition
-        await self.hass.services.async_call(
-            LIGHT_DOMAIN, SERVICE_TURN_ON, state, context=self.context
-        )
+        await self._send(state)
+        unsent.discard(ATTR_COLOR_TEMP_KELVIN)
         await asyncio.sleep(0.5 + state[ATTR_TRANSITION])
-        await self.hass.services.async_call(
-            LIGHT_DOMAIN, SERVICE_TURN_ON, brightness_only, context = self.context
+        await self._send(brightness_only)
+        unsent.discard(ATTR_BRIGHTNESS)
+
+    async def _async_turn_on(self, state, unsent, after = None):
+        if after is not None:
+            await after.wait()
+        await self._send(state)
+        unsent.clear()
+
+    async def _async_probe_turn_on(self, entity_id, state, unsent):
+        # send brightness and temperature together, then see whether the
+        # light got to both once it's had time to. The attributes stay
+        # unsent until then, so the check for manual changes leaves them be.
+        await self._send(state)
+        await asyncio.sleep(1 + state[ATTR_TRANSITION])
+        current = self._snapshot.get(entity_id)
+        if current and current.on:
+            profile = self._lights_by_id[entity_id].profile
+            capabilities = current.capabilities
+            # only what it can report counts, like Delivery.outcome
+            reached = all(value is not None and abs(value - state[attr]) <= delta
+                          for (attr, value, delta, supported) in (
+                              (ATTR_BRIGHTNESS, current.brightness,
+                               profile.brightness_update_delta, capabilities.supports_brightness),
+                              (ATTR_COLOR_TEMP_KELVIN, current.temperature,
+                               profile.temperature_update_delta, capabilities.supports_temperature))
+                          if supported)
+            log.info("%s %s brightness and temperature changing together", entity_id,
+                     "handles" if reached else "can't handle")
+            self._capabilities.learned(entity_id, reached)
+            if not(reached):
+                # try again split next tick, rather than thinking it was
+                # changed by hand
+                self._expected_brightness.pop(entity_id, None)
+                self._expected_temperature.pop(entity_id, None)
+                self._snapshot.mark_dirty([entity_id])
+                self._schedule_recheck(0)
+        unsent.clear()
+
+    def _send(self, state):
+        return self._dispatcher.async_run(
+            partial(self.hass.services.async_call,
+                    LIGHT_DOMAIN, SERVICE_TURN_ON, state,
+                    blocking = True, context = self.context)
         )
             
     async def async_added_to_hass(self):
-        self.async_on_remove(
-            setup_service_call_interceptor(
-                self.hass,
-                LIGHT_DOMAIN,
-                SERVICE_TURN_ON,
-                self._intercept_service_call
-            )
-        )
-
-        self.async_on_remove(
-            setup_service_call_interceptor(
-                self.hass,
-                LIGHT_DOMAIN,
-                SERVICE_TOGGLE,
-                self._intercept_service_call
+        # warm the sun times cache so turn_on interception doesn't have to
+        await async_get_sun_times(self.hass).async_refresh()
+
+        for service in (SERVICE_TURN_ON, SERVICE_TOGGLE):
+            self.async_on_remove(
+                async_get_interceptor_hub(self.hass, LIGHT_DOMAIN, service).async_register(
+                    self._lights_by_id.keys(),
+                    self._timed_intercept_service_call
+                )
             )
-        )
         
-        self.async_on_remove(
-            async_track_time_interval(self.hass, self.update_lights, self._update_interval)
-        )
+        if self._discover_groups:
+            self.async_on_remove(
+                async_get_group_discovery(self.hass).async_add_listener(
+                    self._update_discovered_groups
+                )
+            )
+            self._update_discovered_groups()
+
+        self.async_on_remove(self._cancel_recheck)
+        if self._adaptive_schedule:
+            self.async_on_remove(self._cancel_scheduled_update)
+        if self._shared_tick:
+            self._coordinator = async_get_tick_coordinator(self.hass)
+            self.async_on_remove(self._coordinator.async_register(self))
+        elif not(self._adaptive_schedule):
+            self.async_on_remove(
+                async_track_time_interval(self.hass, self.update_lights, self._update_interval)
+            )
+
+        for entity_id in self._lights_by_id:
+            self._snapshot.update(entity_id, self.hass.states.get(entity_id))
 
         async def on_state_change(event):
             entity_id = event.data["entity_id"]
             to_state = event.data["new_state"]
-            if to_state == "off":
+            self._snapshot.update(entity_id, to_state)
+            if not(to_state and to_state.state == STATE_ON):
                 self.clear_overrides_and_expectations(entity_id)
+
+            if self._adaptive_schedule and self._state:
+                # a light coming on needs adapting now, not when the curve
+                # next moves; wait out the debounce in update_lights first
+                from_state = event.data["old_state"]
+                if to_state and to_state.state == STATE_ON and \
+                   not(from_state and from_state.state == STATE_ON):
+                    self._schedule_update(dt_util.utcnow() + datetime.timedelta(seconds = 1.5))
         
         self.async_on_remove(
             async_track_state_change_event(self.hass,
@@ -428,11 +1087,34 @@ class MainSwitch(SwitchEntity, RestoreEntity):
         if self._state is not None: return
         state = await self.async_get_last_state()
         self._state = state and state.state == STATE_ON
+        if self._state:
+            extra = await self.async_get_last_extra_data()
+            if extra:
+                self._restore_data(extra.as_dict())
+        if self._warm_start:
+            self._warm_start_until = dt_util.utcnow() + self._warm_start
 
         await self.update_lights()
         
+    async def _timed_intercept_service_call(self, call, data):
+        started = time.perf_counter()
+        try:
+            runner = await self._intercept_service_call(call, data)
+        finally:
+            self._metrics.interceptor_latency.add((time.perf_counter() - started) * 1000)
+        if runner is None:
+            # the next tick shows it
+            return None
+
+        async def run_then_update(job):
+            # the latency sensor only, and not until the user's call is done
+            try:
+                return await runner(job)
+            finally:
+                self._metrics.async_updated("interceptor_latency")
+        return run_then_update
+
     async def _intercept_service_call(self, call, data):
-        log.info(f"maybe intercept {call} {data}")
         if not(self._state):
             return
         # annoyingly there is no way to walk the chain of parents
@@ -464,10 +1146,20 @@ class MainSwitch(SwitchEntity, RestoreEntity):
         target_state = {}
         times = None
 
+        # the user's call wins over anything we were about to send; pending
+        # commands are by light, so a group means its members
+        called = [m for e in entities if e in self._lights_by_id
+                  for m in self._group_members(e)]
+        self._supersede(called)
+        for e in called:
+            self._deliveries.discard(e)
+            self._fades.pop(e, None)
+
         for entity in entities:
             if entity in self._lights_by_id:
-                cur_state = self.hass.states.get(entity)
-                is_on = cur_state and cur_state.state == STATE_ON
+                targets_my_entity = True
+                cur_state = self._snapshot.get(entity)
+                is_on = cur_state and cur_state.on
 
                 if not(self._sleep_mode):
                     if not(times): times = get_times(self.hass)
@@ -482,7 +1174,7 @@ class MainSwitch(SwitchEntity, RestoreEntity):
                 else:
                     tgt[ATTR_BRIGHTNESS] = evaluate_brightness(self._sleep_mode,
                                                                times,
-                                                               light)
+                                                               light.profile)
                 if control_temperature:
                     self.set_manual_temperature(entity)
                 elif is_on:
@@ -490,7 +1182,10 @@ class MainSwitch(SwitchEntity, RestoreEntity):
                 else:
                     tgt[ATTR_COLOR_TEMP_KELVIN] = evaluate_temperature(self._sleep_mode,
                                                                        times,
-                                                                       light)
+                                                                       light.profile)
+                    if cur_state:
+                        tgt[ATTR_COLOR_TEMP_KELVIN] = \
+                            cur_state.capabilities.clamp_kelvin(tgt[ATTR_COLOR_TEMP_KELVIN])
 
 
                 if tgt:
@@ -504,7 +1199,9 @@ class MainSwitch(SwitchEntity, RestoreEntity):
                 log.warning("divergent values %s", target_state)
 
             value = target_values[0]
-            log.info("Adapt to %s", value)
+            for eid in target_state:
+                self._trace.record(trace.REWRITTEN, eid,
+                                   value.get(ATTR_BRIGHTNESS), value.get(ATTR_COLOR_TEMP_KELVIN))
 
             if ATTR_COLOR_TEMP_KELVIN in value:
                 params[ATTR_COLOR_TEMP_KELVIN] = value[ATTR_COLOR_TEMP_KELVIN]
@@ -515,15 +1212,41 @@ class MainSwitch(SwitchEntity, RestoreEntity):
                 params[ATTR_BRIGHTNESS] = value[ATTR_BRIGHTNESS]
                 for eid in target_state:
                     self._expected_brightness[eid] = value[ATTR_BRIGHTNESS]
+
+            # lights making up whole groups get the group instead, so a
+            # scene costs a message per group and its lights change together
+            # (only groups HA can actually send to)
+            plan, _ = self._group_index.plan(target_state)
+            groups = [g for g in plan if g not in target_state and self._available(g)]
+            if groups:
+                covered = {e for g in groups for e in self._group_index.groups[g]}
+                data[ATTR_ENTITY_ID] = list(dict.fromkeys(
+                    [e for e in entities if e not in covered] + groups
+                ))
+                for g in groups:
+                    self._trace.record(trace.GROUPED, g,
+                                       value.get(ATTR_BRIGHTNESS), value.get(ATTR_COLOR_TEMP_KELVIN))
         elif target_state:
             log.warning("call covers other entities, fail")
-        log.debug(f"adapted state {params}")
+
+        if targets_my_entity:
+            # send it through the interactive lane, ahead of any adaptation
+            return self._dispatcher.async_run_interactive
 
             
+    def _available(self, entity_id):
+        state = self.hass.states.get(entity_id)
+        return state is not None and state.state != STATE_UNAVAILABLE
+
     async def async_set_sleep_mode(self, sleep_mode):
         if self._sleep_mode != sleep_mode:
+            restoring = self._sleep_mode is None
             self._sleep_mode = sleep_mode
-            self.clear_overrides_and_expectations()
+            if restoring:
+                # what we restored was for this sleep mode
+                self._snapshot.mark_dirty()
+            else:
+                self.clear_overrides_and_expectations()
             await self.update_lights()
 
     def clear_overrides_and_expectations(self, entity_id = None):
@@ -532,11 +1255,16 @@ class MainSwitch(SwitchEntity, RestoreEntity):
             self._manual_temperature.discard(entity_id)
             self._expected_brightness.pop(entity_id, None)
             self._expected_temperature.pop(entity_id, None)
+            self._deliveries.discard(entity_id)
+            self._fades.pop(entity_id, None)
         else:
+            self._deliveries.clear()
+            self._fades.clear()
             self._expected_temperature = {}
             self._expected_brightness = {}
             self._manual_temperature = set()
             self._manual_brightness = set()
+            self._snapshot.mark_dirty()
             
     async def async_turn_on(self, **kwargs):
         self._state = True
@@ -545,6 +1273,9 @@ class MainSwitch(SwitchEntity, RestoreEntity):
 
     async def async_turn_off(self, **kwargs):
         self._state = False
+        self._cancel_scheduled_update()
+        self._cancelled(self._pending.cancel_all())
+        self._cancel_recheck()
         self.clear_overrides_and_expectations()
         
 class SleepSwitch(SwitchEntity, RestoreEntity):
@@ -586,50 +1317,23 @@ class SleepSwitch(SwitchEntity, RestoreEntity):
         self._state = False
         await self._main_switch.async_set_sleep_mode(self._state)
 
-def get_times(hass):
-    now = dt_util.utcnow() #await self.hass.async_add_executor_job(dt_util.utcnow)
-    loc, _ = get_astral_location(hass)
-    today = now.replace(hour = 0, minute = 0, second = 0)
-    sunrise = loc.sunrise(today)
-    sunset = loc.sunset(today)
-    noon = loc.noon(today)
-
-    sunrise = (sunrise.hour + sunrise.minute / 60) / 24
-    sunset = (sunset.hour + sunset.minute / 60) / 24
-    noon = (noon.hour + noon.minute / 60) / 24
-    now = (now.hour + now.minute / 60) / 24
+def needs_split(state):
+    return ATTR_TRANSITION in state \
+        and state[ATTR_TRANSITION] > 0 \
+        and ATTR_BRIGHTNESS in state \
+        and ATTR_COLOR_TEMP_KELVIN in state
 
-    return (now, sunrise, noon, sunset)
-
-def evaluate_brightness(sleep_mode, times, light):
-    log.debug("eval brightness for %s, %s, %s", sleep_mode, times, light)
+def evaluate_brightness(sleep_mode, times, profile):
     if sleep_mode:
-        return light.get("sleep_brightness")
+        return profile.sleep_brightness
     else:
-        return evaluate_curve(times,
-                              light.get("brightness_k"),
-                              light.get("brightness_x"),
-                              light.get("brightness_min"),
-                              light.get("brightness_max"))
-
-def evaluate_temperature(sleep_mode, times, light):
-    log.debug("eval temperature for %s, %s, %s", sleep_mode, times, light)
+        return curve_tables.lookup(times, *profile.brightness_curve)
+
+def evaluate_temperature(sleep_mode, times, profile):
     if sleep_mode:
-        return light.get("sleep_temperature")
-    else:
-        return evaluate_curve(times,
-                              light.get("temperature_k"),
-                              light.get("temperature_x"),
-                              light.get("temperature_min"),
-                              light.get("temperature_max"))
-
-def evaluate_curve(times, k, x, minimum, maximum):
-    now, sunrise, noon, sunset = times
-    if now < noon:
-        x = (1+tanh(k*(now - (sunrise + x))))/2
+        return profile.sleep_temperature
     else:
-        x = (1+tanh(k*(sunset - (now + x))))/2
-    return int(minimum + (maximum - minimum) * x)
+        return curve_tables.lookup(times, *profile.temperature_curve)
 
 def all_equal(xs):
     first = True
@@ -0,0 +1,44 @@
+"""
+A record of what a switch decided, for when lights do something odd.
+
+Logging every target and service call costs string formatting on every
+tick even when nobody is looking, so instead each decision is written as
+a plain tuple into a fixed size ring, and only turned into anything
+readable when the solar_lighting.dump_trace service asks for it.
+"""
+import time
+import datetime
+
+DATA_TRACES = "traces"
+
+# event kinds
+TARGET = "target"
+GROUPED = "grouped"
+DEBOUNCED = "debounced"
+DEFERRED = "deferred"
+MANUAL_BRIGHTNESS = "manual_brightness"
+MANUAL_TEMPERATURE = "manual_temperature"
+MISSED = "missed"
+REWRITTEN = "rewritten"
+
+class TraceBuffer:
+    def __init__(self, size):
+        self._events = [None] * size
+        self._next = 0
+        self.size = size
+
+    def record(self, kind, entity_id, brightness = None, temperature = None):
+        if not(self.size): return
+        self._events[self._next] = (time.time(), kind, entity_id, brightness, temperature)
+        self._next = (self._next + 1) % self.size
+
+    def events(self):
+        """The events, oldest first"""
+        ordered = self._events[self._next:] + self._events[:self._next]
+        return [{"time": datetime.datetime.fromtimestamp(t, datetime.timezone.utc).isoformat(),
+                 "event": kind,
+                 "entity_id": entity_id,
+                 "brightness": brightness,
+                 "temperature": temperature}
+                for (t, kind, entity_id, brightness, temperature)
+                in (e for e in ordered if e is not None)]